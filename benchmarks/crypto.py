@@ -0,0 +1,59 @@
+"""Measure the decryption throughput against vault size and thread count.
+
+Usage: python -m benchmarks.crypto [size ...]
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from time import perf_counter
+
+from server import config, crypto
+
+KEY = sha256(b"benchmark").digest()
+SIZES = (100, 1000, 10000, 30000)
+WORKERS = (1, 2, 4, 8)
+ROUNDS = 3
+
+
+def make_rows(size: int):
+    """Build encrypted identifiers, as stored in the database."""
+    return [{
+        "context": f"context{index}",
+        "username": f"username{index}",
+        "password": password,
+        "nonce": nonce,
+    } for index, (password, nonce) in enumerate(
+        crypto.encrypt_one(KEY, f"password{index:016}")
+        for index in range(size))]
+
+
+async def measure(size: int, workers: int) -> float:
+    """Get the best decryption throughput, in identifiers per second."""
+    config.CRYPTO_WORKERS = workers
+    app = {"crypto.executor": ThreadPoolExecutor(max_workers=workers)}
+    rows = make_rows(size)
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        await crypto.decrypt(app, KEY, rows)
+        best = min(best, perf_counter() - start)
+    app["crypto.executor"].shutdown()
+    return size / best
+
+
+async def main(sizes) -> None:
+    """Run the benchmarks."""
+    print(f"{'identifiers':>12}" +
+          "".join(f"{workers:>10} thr" for workers in WORKERS))
+    for size in sizes:
+        results = [await measure(size, workers) for workers in WORKERS]
+        print(f"{size:>12}" +
+              "".join(f"{result:>12.0f}/s" for result in results))
+
+
+if __name__ == "__main__":
+    asyncio.run(main([int(size) for size in sys.argv[1:]] or SIZES))
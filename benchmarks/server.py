@@ -0,0 +1,219 @@
+"""Measure the throughput and latency of the server's hot paths.
+
+The server runs on the in-memory database backend, behind aiohttp's test
+server, driven by concurrent clients each logged in as its own user with a
+vault of the given size. Results are printed as JSON.
+
+Usage: python -m benchmarks.server [--scenario NAME ...]
+       [--concurrency N ...] [--vault N ...] [--requests N] [--iterations N]
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import typing as t
+from hashlib import sha256
+from itertools import count
+from time import perf_counter
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+from cryptography import fernet
+
+from server import config, crypto, kdf, queries
+from server.main import make_app
+
+PASSWORD = "benchmark password"
+WARMUP = 5
+
+Scenario = t.Callable[[aiohttp.ClientSession, TestServer, int, int, int],
+                      t.Awaitable[int]]
+
+
+async def login(client: aiohttp.ClientSession, server: TestServer,
+                worker: int, request: int, vault: int) -> int:
+    """Log in, deriving the password hash."""
+    async with client.post(server.make_url("/user/login"),
+                           json={
+                               "username": f"user{worker}",
+                               "password": PASSWORD,
+                           }) as response:
+        await response.read()
+        return response.status
+
+
+async def get(client: aiohttp.ClientSession, server: TestServer, worker: int,
+              request: int, vault: int) -> int:
+    """Read and decrypt the whole vault."""
+    async with client.get(server.make_url("/identifiers/get")) as response:
+        await response.read()
+        return response.status
+
+
+async def insert(client: aiohttp.ClientSession, server: TestServer,
+                 worker: int, request: int, vault: int) -> int:
+    """Insert a new identifier."""
+    async with client.post(server.make_url("/identifiers/insert"),
+                           json={
+                               "context": f"inserted{request}",
+                               "username": "username",
+                               "password": "password",
+                           }) as response:
+        await response.read()
+        return response.status
+
+
+async def upsert(client: aiohttp.ClientSession, server: TestServer,
+                 worker: int, request: int, vault: int) -> int:
+    """Overwrite an existing identifier."""
+    async with client.post(server.make_url("/identifiers/upsert"),
+                           json={
+                               "context": f"context{request % vault}",
+                               "username": "username",
+                               "password": f"password{request}",
+                           }) as response:
+        await response.read()
+        return response.status
+
+
+async def password(client: aiohttp.ClientSession, server: TestServer,
+                   worker: int, request: int, vault: int) -> int:
+    """Change the password, re-encrypting the whole vault."""
+    async with client.post(server.make_url("/user/password"),
+                           json={"password": PASSWORD}) as response:
+        await response.read()
+        return response.status
+
+
+SCENARIOS: t.Dict[str, Scenario] = {
+    "login": login,
+    "get": get,
+    "insert": insert,
+    "upsert": upsert,
+    "password": password,
+}
+
+
+async def seed(app, users: int, vault: int) -> None:
+    """Create the users, and fill their vaults."""
+    salt = os.urandom(config.SALT_LENGTH)
+    hashed = kdf.hash_password(config.KDF_ALGORITHM, config.KDF_PARAMETERS,
+                               bytes(PASSWORD, "utf8"), salt)
+    key = sha256(bytes(PASSWORD, "utf8")).digest()
+    async with app["asyncpg.pool"].acquire() as database:
+        for user in range(users):
+            row = await database.fetchrow(queries.CREATE_USER, f"user{user}",
+                                          hashed, salt, config.KDF_ALGORITHM,
+                                          list(config.KDF_PARAMETERS), False)
+            await database.executemany(queries.INSERT_IDENTIFIER, [
+                (row["id"], f"context{index}", "username",
+                 *crypto.encrypt_one(key, f"password{index}"))
+                for index in range(vault)
+            ])
+
+
+async def run(name: str, concurrency: int, vault: int,
+              requests: int) -> t.Dict[str, t.Any]:
+    """Run a scenario, and measure its latencies."""
+    scenario = SCENARIOS[name]
+    server = TestServer(await make_app())
+    await server.start_server()
+    await seed(server.app, concurrency, vault)
+
+    latencies: t.List[float] = []
+    errors = 0
+    counter = count()
+
+    async def work(worker: int) -> None:
+        """Log in, warm up, then send requests until enough were sent."""
+        nonlocal errors
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(
+                unsafe=True)) as client:
+            await login(client, server, worker, 0, vault)
+            for request in range(WARMUP):
+                await scenario(client, server, worker, -request - 1, vault)
+            ready[worker].set()
+            await go.wait()
+            while (request := next(counter)) < requests:
+                sent = perf_counter()
+                status = await scenario(client, server, worker, request,
+                                        vault)
+                latencies.append(perf_counter() - sent)
+                errors += status >= 400
+
+    ready = [asyncio.Event() for _ in range(concurrency)]
+    go = asyncio.Event()
+    tasks = [
+        asyncio.create_task(work(worker)) for worker in range(concurrency)
+    ]
+    for event in ready:
+        await event.wait()
+    started = perf_counter()
+    go.set()
+    await asyncio.gather(*tasks)
+    elapsed = perf_counter() - started
+    await server.close()
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "vault": vault,
+        "requests": requests,
+        "errors": errors,
+        "rps": requests / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1,
+                                len(latencies) * 99 // 100)] * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Run the benchmarks."""
+    config.DATABASE_BACKEND = "memory"
+    config.SESSION_BACKEND = "memory"
+    config.KDF_ALGORITHM = "pbkdf2_sha256"
+    config.KDF_PARAMETERS = (args.iterations, )
+    config.RATE_LIMIT_RATE = config.RATE_LIMIT_BURST = float("inf")
+    config.SESSION_SECRET = fernet.Fernet.generate_key().decode("ascii")
+
+    results = []
+    for name in args.scenario:
+        for concurrency in args.concurrency:
+            for vault in args.vault:
+                results.append(await run(name, concurrency, vault,
+                                         args.requests))
+    print(
+        json.dumps(
+            {
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "hash_iterations": args.iterations,
+                "results": results,
+            },
+            indent=2,
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.server",
+                                     description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario",
+                        nargs="+",
+                        choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 16])
+    parser.add_argument("--vault", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=10000,
+        help="PBKDF2 iterations, lower than in production to keep the run "
+        "short (default: 10000)",
+    )
+    asyncio.run(main(parser.parse_args()))
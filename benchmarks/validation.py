@@ -0,0 +1,147 @@
+"""Measure the per-request overhead of the validation decorators.
+
+Each case runs with the current decorators, then with the legacy ones,
+which decoded the body again in every decorator and in the handler.
+
+Usage: python -m benchmarks.validation [iterations]
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import json
+import sys
+import typing as t
+from time import perf_counter
+
+from aiohttp import web
+
+from server.utils import get_json, optional, required
+
+BODY = json.dumps({
+    "context": "github.com",
+    "username": "faholan",
+    "password": "hunter2",
+}).encode()
+ROUNDS = 5
+
+
+class Request(dict):
+    """Stand-in for an aiohttp request whose body is already buffered.
+
+    Like aiohttp, the body is read once but decoded on every call.
+    """
+    def __init__(self, body: bytes) -> None:
+        """Store the body."""
+        super().__init__()
+        self.body = body
+
+    async def read(self) -> bytes:
+        """Get the raw body."""
+        return self.body
+
+    async def text(self) -> str:
+        """Decode the body."""
+        return self.body.decode("utf8")
+
+    async def json(self) -> t.Any:
+        """Decode the body as JSON."""
+        return json.loads(await self.text())
+
+
+async def handler(request: web.Request) -> web.Response:
+    """Read the payload, as the real handlers do."""
+    await get_json(request)
+    return web.Response()
+
+
+async def legacy_handler(request: web.Request) -> web.Response:
+    """Read the payload, as the handlers did."""
+    await request.json()
+    return web.Response()
+
+
+def wrong_type(name: str, datatype: t.Type) -> web.HTTPBadRequest:
+    """Build the error of a field of the wrong type, as it was."""
+    return web.HTTPBadRequest(
+        reason=f"Field {name} must be of type {datatype}",
+        text=json.dumps({
+            "success": False,
+            "msg": f"Field {name} must be of type {datatype}",
+            "error_code": "wrong_field_type",
+        }),
+    )
+
+
+def legacy_required(**fields: t.Type):
+    """Require fields, as the decorator did before compiling its checks."""
+    def callback(handler):
+        """Handle the function conversion."""
+        async def check_and_run(request: web.Request) -> web.Response:
+            data = await request.json()
+            for name, datatype in fields.items():
+                if name not in data:
+                    raise web.HTTPBadRequest(reason=f"Missing field {name}")
+                if not isinstance(data[name], datatype):
+                    raise wrong_type(name, datatype)
+            return await handler(request)
+
+        return check_and_run
+
+    return callback
+
+
+def legacy_optional(**fields: t.Type):
+    """Check optional fields, as the decorator did before."""
+    def callback(handler):
+        """Handle the function conversion."""
+        async def check_and_run(request: web.Request) -> web.Response:
+            if await request.text() == "":
+                return await handler(request)
+            data = await request.json()
+            for name, datatype in fields.items():
+                if name in data and not isinstance(data[name], datatype):
+                    raise wrong_type(name, datatype)
+            return await handler(request)
+
+        return check_and_run
+
+    return callback
+
+
+async def measure(name: str, wrapped, iterations: int) -> None:
+    """Time the wrapped handler, keeping the best of several rounds."""
+    best = float("inf")
+    for _ in range(ROUNDS):
+        requests = [Request(BODY) for _ in range(iterations)]
+        start = perf_counter()
+        for request in requests:
+            await wrapped(request)
+        best = min(best, perf_counter() - start)
+    print(f"{name:<28} {best / iterations * 1e6:8.2f} µs/request")
+
+
+async def main(iterations: int) -> None:
+    """Run the benchmarks."""
+    for prefix, body, required_, optional_ in (
+        ("", handler, required, optional),
+        ("legacy ", legacy_handler, legacy_required, legacy_optional),
+    ):
+        await measure(f"{prefix}handler", body, iterations)
+        await measure(
+            f"{prefix}required",
+            required_(context=str, username=str, password=str)(body),
+            iterations,
+        )
+        await measure(f"{prefix}optional",
+                      optional_(context=str, username=str)(body), iterations)
+        await measure(
+            f"{prefix}required+optional",
+            required_(context=str,
+                      username=str)(optional_(password=str)(body)),
+            iterations,
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -3,10 +3,86 @@
 Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
+import argparse
+import asyncio
+import logging
+
+import asyncpg
 from aiohttp import web
 
-from . import config
+from . import config, kdf, schema, workers
 from .main import make_app
 
+
+async def migrate() -> None:
+    """Apply the pending migrations."""
+    database = await asyncpg.connect(**config.POSTGRESQL)
+    try:
+        applied = await schema.migrate(database)
+        print(f"{applied} migration(s) applied")
+        for index in await schema.check(database):
+            print(f"Missing {index}")
+    finally:
+        await database.close()
+
+
+def calibrate(algorithm: str, target: float) -> None:
+    """Suggest key derivation parameters for this host."""
+    print(f"Timing {algorithm} for {target}s per hash...")
+    parameters = kdf.calibrate(algorithm, target)
+    print("Suggested config:")
+    print(f'KDF_ALGORITHM = "{algorithm}"')
+    print(f"KDF_PARAMETERS = {parameters!r}")
+    if (algorithm, tuple(parameters)) != (config.KDF_ALGORITHM,
+                                          tuple(config.KDF_PARAMETERS)):
+        print("Existing hashes are updated as their users log in.")
+
+
 if __name__ == "__main__":
-    web.run_app(make_app(), **config.AIOHTTP)
+    parser = argparse.ArgumentParser(prog="python -m server",
+                                     description="Password manager server")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=("run", "migrate", "calibrate"),
+        help="run the server (default), migrate the database, or suggest "
+        "key derivation parameters",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.WORKERS,
+        metavar="N",
+        help="number of server processes sharing the port",
+    )
+    parser.add_argument(
+        "--algorithm",
+        choices=kdf.ALGORITHMS,
+        default=config.KDF_ALGORITHM,
+        help="key derivation function to calibrate",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=config.KDF_TARGET_SECONDS,
+        metavar="SECONDS",
+        help="time a hash should take when calibrating",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "migrate":
+        asyncio.run(migrate())
+    elif args.command == "calibrate":
+        calibrate(args.algorithm, args.target)
+    elif args.workers > 1:
+        if config.SESSION_BACKEND == "memory":
+            parser.error("sessions of the memory backend are not shared "
+                         "between workers: set SESSION_BACKEND to postgres "
+                         "or cookie")
+        workers.supervise(args.workers)
+    else:
+        web.run_app(make_app(),
+                    shutdown_timeout=config.SHUTDOWN_TIMEOUT,
+                    **config.AIOHTTP)
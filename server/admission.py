@@ -0,0 +1,84 @@
+"""Admission control for expensive endpoints.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import typing as t
+from collections import OrderedDict
+from time import monotonic
+
+from aiohttp import web
+
+from . import config, kdf
+from .responses import Failure
+
+
+class Limiter:
+    """Bound the concurrent work, with a bounded waiting queue."""
+    def __init__(self, concurrency: int, queue_size: int,
+                 timeout: float) -> None:
+        """Initialize the limiter."""
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Error returned when the server is saturated
+        self._busy = Failure(
+            web.HTTPServiceUnavailable,
+            "Server busy",
+            "server_busy",
+            headers={"Retry-After": str(max(1, round(timeout)))},
+        )
+
+    async def __aenter__(self) -> None:
+        """Wait for a free slot, or fail fast if the queue is full."""
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            raise self._busy()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._busy() from None
+        finally:
+            self.waiting -= 1
+
+    async def __aexit__(self, *_) -> None:
+        """Release the slot."""
+        self._semaphore.release()
+
+
+class RateLimiter:
+    """Token buckets, one per remote address."""
+    def __init__(self, rate: float, burst: int, max_entries: int) -> None:
+        """Initialize the buckets."""
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets: t.OrderedDict[str, t.Tuple[float, float]] = (
+            OrderedDict())
+
+    def allow(self, remote: t.Optional[str]) -> bool:
+        """Take a token from the remote's bucket, if there is one left."""
+        now = monotonic()
+        tokens, last = self._buckets.pop(remote, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[remote] = (tokens - allowed, now)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+async def startup(app: web.Application) -> None:
+    """Create the limiters."""
+    app["admission.kdf"] = Limiter(
+        kdf.pool_size(app["workers"]),
+        config.KDF_QUEUE_SIZE,
+        config.KDF_QUEUE_TIMEOUT,
+    )
+    app["admission.rate"] = RateLimiter(
+        config.RATE_LIMIT_RATE,
+        config.RATE_LIMIT_BURST,
+        config.RATE_LIMIT_ENTRIES,
+    )
@@ -0,0 +1,126 @@
+"""Audit log of authentication and vault events.
+
+Requests only queue their events. A background task writes them to the
+audit_log table in batches, with COPY. When the queue is full, new events
+are dropped or the requests recording them wait, following AUDIT_POLICY,
+for AUDIT_BLOCK_TIMEOUT at most.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import logging
+import typing as t
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from . import config, metrics
+from .responses import dumps
+
+logger = logging.getLogger(__name__)
+
+# Time, event, user id, remote address and details
+Event = t.Tuple[datetime, str, t.Optional[int], t.Optional[str],
+                t.Optional[str]]
+COLUMNS = ("time", "event", "user_id", "remote", "detail")
+
+
+class AuditLog:
+    """Queue of events, written in batches by a background task."""
+    def __init__(self, pool: t.Any) -> None:
+        """Initialize the queue."""
+        self.pool = pool
+        self.queue: "asyncio.Queue[Event]" = asyncio.Queue(
+            config.AUDIT_QUEUE_SIZE)
+        self._task: t.Optional[asyncio.Task] = None
+        # Events taken from the queue, not written yet
+        self._batch: t.List[Event] = []
+
+    def start(self) -> None:
+        """Start writing the events."""
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, event: Event) -> None:
+        """Queue an event, applying the policy if the queue is full.
+
+        Even when blocking, the event is dropped after AUDIT_BLOCK_TIMEOUT,
+        not to hold the requests while the writes keep failing.
+        """
+        try:
+            if config.AUDIT_POLICY == "block":
+                await asyncio.wait_for(self.queue.put(event),
+                                       config.AUDIT_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(event)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            metrics.AUDIT_EVENTS.inc("dropped")
+
+    def _take(self, count: int) -> t.List[Event]:
+        """Take up to count events from the queue, without waiting."""
+        return [
+            self.queue.get_nowait()
+            for _ in range(min(count, self.queue.qsize()))
+        ]
+
+    async def _write(self, batch: t.List[Event]) -> None:
+        """Write a batch of events."""
+        async with self.pool.acquire() as database:
+            await database.copy_records_to_table(
+                "audit_log",
+                records=batch,
+                columns=COLUMNS,
+            )
+        metrics.AUDIT_EVENTS.inc("written", amount=len(batch))
+
+    async def _run(self) -> None:
+        """Write the events until cancelled, retrying the failed writes."""
+        while True:
+            self._batch = [await self.queue.get()]
+            # Let the batch fill up, unless it already can
+            if self.queue.qsize() < config.AUDIT_BATCH_SIZE - 1:
+                await asyncio.sleep(config.AUDIT_FLUSH_INTERVAL)
+            self._batch += self._take(config.AUDIT_BATCH_SIZE - 1)
+            while True:
+                try:
+                    await self._write(self._batch)
+                    break
+                # The events wait in memory, and the queue applies the policy
+                except Exception:
+                    logger.exception("Cannot write %d audit events, retrying",
+                                     len(self._batch))
+                    await asyncio.sleep(config.AUDIT_RETRY_DELAY)
+            self._batch = []
+
+    async def close(self) -> None:
+        """Stop the background task, and write the queued events."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        batch, self._batch = self._batch, []
+        while batch := batch + self._take(config.AUDIT_BATCH_SIZE -
+                                          len(batch)):
+            try:
+                await self._write(batch)
+            except Exception:
+                lost = len(batch) + self.queue.qsize()
+                logger.exception("Cannot write %d audit events, lost", lost)
+                metrics.AUDIT_EVENTS.inc("dropped", amount=lost)
+                return
+            batch = []
+
+
+async def record(request: web.Request,
+                 event: str,
+                 user_id: t.Optional[int] = None,
+                 **detail: t.Any) -> None:
+    """Queue an event of the audit log, if enabled."""
+    audit_log = request.app.get("audit.log")
+    if audit_log is not None:
+        await audit_log.put((
+            datetime.now(timezone.utc),
+            event,
+            user_id,
+            request.remote,
+            dumps(detail).decode("utf8") if detail else None,
+        ))
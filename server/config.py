@@ -11,18 +11,159 @@ POSTGRESQL = {
     "port": 5432,
 }
 
+# "postgres", or "memory" to run without a database (nothing is persisted)
+DATABASE_BACKEND = "postgres"
+
+# Apply the pending migrations on startup
+AUTO_MIGRATE = True
+
+# Connections per worker. Keep max size times the number of workers well
+# under the server's max_connections.
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+# Seconds after which idle connections are closed, down to the min size
+POOL_MAX_INACTIVE_LIFETIME = 300.0
+# Queries after which a connection is replaced
+POOL_MAX_QUERIES = 50000
+# Seconds a request waits for a connection before failing with a 503
+POOL_ACQUIRE_TIMEOUT = 2.0
+# Client-side timeout of each command, in seconds (None: no timeout)
+POOL_COMMAND_TIMEOUT = None
+# Server-side timeout of each statement, exports included
+STATEMENT_TIMEOUT = "60s"
+
 COOKIE_NAME = "Faholan.Manager.storage"
 
-HASH_ITERATIONS = 1000000
+# Fernet key encrypting sessions (url-safe base64 of 32 bytes). When None,
+# it is read from the key file, created on first start, so that sessions
+# survive restarts and are valid in every worker.
+SESSION_SECRET = None
+SESSION_KEY_FILE = "session.key"
+
+# Where sessions are kept: "memory", "postgres" (memory backed by the
+# session_store table) or "cookie" (encrypted in the cookie itself)
+SESSION_BACKEND = "memory"
+SESSION_MAX_AGE = 86400  # seconds
+SESSION_CACHE_SIZE = 100000  # sessions kept in memory at most
+
+# Key derivation of new password hashes: "pbkdf2_sha256" with (iterations, )
+# or "scrypt" with (n, r, p). Hashes keep the parameters they were made with,
+# and are redone with these on the next login of their user.
+# python -m server calibrate suggests parameters for this host.
+KDF_ALGORITHM = "pbkdf2_sha256"
+KDF_PARAMETERS = (1000000, )
+# Hashing time aimed at by calibrate, in seconds
+KDF_TARGET_SECONDS = 0.5
+# Most memory calibrate lets a scrypt hash use, in bytes
+KDF_MAX_MEMORY = 64 * 1024 * 1024
+
+# Number of processes hashing passwords (None: one per CPU), shared between
+# the server workers
+KDF_WORKERS = None
+# Hashing requests allowed to wait for a worker, and for how many seconds
+KDF_QUEUE_SIZE = 32
+KDF_QUEUE_TIMEOUT = 5.0
+
+# Per remote address token bucket for login and user management
+RATE_LIMIT_RATE = 0.5  # tokens per second
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_ENTRIES = 65536  # remote addresses tracked at most
 
 SALT_LENGTH = 32
 NONCE_LENGTH = 16
 
+# Threads encrypting and decrypting identifiers. Sets of identifiers
+# smaller than the threshold are processed inline, larger ones are split
+# into one chunk per thread, of at least the minimum size.
+CRYPTO_WORKERS = 4
+CRYPTO_PARALLEL_THRESHOLD = 2000
+CRYPTO_MIN_CHUNK_SIZE = 500
+
+# Identifiers re-encrypted per batch on password change
+REKEY_CHUNK_SIZE = 500
+
+# Identifiers encrypted and copied per batch on import
+IMPORT_CHUNK_SIZE = 1000
+# What to do when an imported identifier exists: "fail", "skip" or "overwrite"
+IMPORT_CONFLICT = "fail"
+
+# Most operations accepted by identifiers/batch
+BATCH_MAX_OPERATIONS = 1000
+
+# Cache of users' identifiers, read by identifiers/get. Each process has
+# its own cache, invalidated by the writes it handles.
+VAULT_CACHE = False
+VAULT_CACHE_BYTES = 256 * 1024 * 1024
+VAULT_CACHE_TTL = 300  # seconds
+# Whether to cache decrypted identifiers, rather than encrypted ones
+VAULT_CACHE_PLAINTEXT = False
+
+# Largest page returned by identifiers/get
+GET_MAX_LIMIT = 10000
+# Rows fetched per round trip when streaming identifiers
+STREAM_PREFETCH = 100
+
+# Most changes returned by identifiers/changes at once
+CHANGES_PAGE_SIZE = 1000
+
+# Results returned by identifiers/search by default, and at most
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+# Least trigram similarity of a fuzzy match, set as pg_trgm's threshold
+SEARCH_SIMILARITY = 0.3
+
+# Notify clients of the writes to their identifiers, over the WebSockets of
+# identifiers/watch. Each process listens for them on its own connection.
+WATCH = True
+# Seconds during which events are gathered before being sent, so that a
+# burst of writes makes a single message per user
+WATCH_COALESCE_DELAY = 0.05
+WATCH_HEARTBEAT = 30.0  # seconds between pings
+# Seconds a message may take to be sent, before its client is dropped
+WATCH_SEND_TIMEOUT = 5.0
+# Seconds between attempts to reopen the listening connection
+WATCH_RECONNECT_DELAY = 5.0
+
 CLASS_NAMES = {
     str: "string",
     int: "integer",
+    bool: "boolean",
+    dict: "object",
+    list: "array",
 }
 
+# Server processes sharing the port, overridden by --workers. Several
+# workers need the "postgres" or "cookie" session backend. With "postgres",
+# each worker caches the sessions only while WATCH tells it of the changes
+# made by the others: otherwise, every request reads and decrypts its
+# session from the database. Other caches and rate limits are per worker.
+WORKERS = 1
+# Seconds left to requests in progress on shutdown
+SHUTDOWN_TIMEOUT = 30.0
+# Least delay between two starts of a worker, in seconds
+WORKER_RESTART_DELAY = 1.0
+
+# Audit log of logins, user creations, password changes and identifier
+# writes, copied in batches into the audit_log table
+AUDIT = True
+AUDIT_QUEUE_SIZE = 10000  # events waiting to be written at most
+# When the queue is full: "block" the requests recording events until
+# there is room, or "drop" their events
+AUDIT_POLICY = "block"
+# Seconds a request waits with the "block" policy, before dropping its event
+AUDIT_BLOCK_TIMEOUT = 1.0
+AUDIT_BATCH_SIZE = 1000  # events written at once at most
+AUDIT_FLUSH_INTERVAL = 1.0  # seconds left for a batch to fill up
+AUDIT_RETRY_DELAY = 5.0  # seconds between attempts to write a batch
+
+# Least size of the response bodies compressed, in bytes (None: never
+# compress). Only compress over TLS if no attacker-chosen text can be
+# reflected next to secrets, or the lengths would leak them (BREACH).
+COMPRESSION_MIN_SIZE = 1400
+
+# Expose Prometheus metrics at /metrics
+METRICS = True
+
 # aiohttp config
 
 AIOHTTP = {
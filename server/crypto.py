@@ -0,0 +1,150 @@
+"""Identifier encryption.
+
+Large sets of identifiers are split into chunks processed on a thread pool,
+the cipher work itself running outside of the GIL.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from os import urandom
+
+from aiohttp import web
+from Cryptodome.Cipher import AES
+
+from . import config, metrics
+
+T = t.TypeVar("T")
+R = t.TypeVar("R")
+
+
+def encrypt_one(key: bytes, password: str) -> t.Tuple[bytes, bytes]:
+    """Encrypt a password, returning it with its nonce."""
+    nonce = urandom(config.NONCE_LENGTH)
+    return AES.new(
+        key,
+        AES.MODE_EAX,
+        nonce=nonce,
+    ).encrypt(bytes(password, "utf8")), nonce
+
+
+def decrypt_one(key: bytes, row) -> t.Dict[str, str]:
+    """Decrypt a stored identifier."""
+    return {
+        "context":
+        row["context"],
+        "username":
+        row["username"],
+        "password":
+        AES.new(
+            key,
+            AES.MODE_EAX,
+            nonce=row["nonce"],
+        ).decrypt(row["password"]).decode("utf8"),
+    }
+
+
+def rekey_one(old_key: bytes, new_key: bytes,
+              row) -> t.Tuple[str, str, bytes]:
+    """Re-encrypt a stored identifier under a new key, with the same nonce."""
+    return (
+        row["context"],
+        row["username"],
+        AES.new(
+            new_key,
+            AES.MODE_EAX,
+            nonce=row["nonce"],
+        ).encrypt(
+            AES.new(
+                old_key,
+                AES.MODE_EAX,
+                nonce=row["nonce"],
+            ).decrypt(row["password"])),
+    )
+
+
+def _encrypt_chunk(
+        key: bytes,
+        passwords: t.Sequence[str]) -> t.List[t.Tuple[bytes, bytes]]:
+    """Encrypt a chunk of passwords."""
+    return [encrypt_one(key, password) for password in passwords]
+
+
+def _decrypt_chunk(key: bytes, rows: t.Sequence) -> t.List[t.Dict[str, str]]:
+    """Decrypt a chunk of identifiers."""
+    return [decrypt_one(key, row) for row in rows]
+
+
+def _rekey_chunk(old_key: bytes, new_key: bytes,
+                 rows: t.Sequence) -> t.List[t.Tuple[str, str, bytes]]:
+    """Re-encrypt a chunk of identifiers."""
+    return [rekey_one(old_key, new_key, row) for row in rows]
+
+
+async def _run(
+    app: web.Application,
+    function: t.Callable[..., t.List[R]],
+    keys: t.Tuple[bytes, ...],
+    items: t.Sequence[T],
+) -> t.List[R]:
+    """Apply a chunk function to items, in parallel if there are many."""
+    if len(items) < config.CRYPTO_PARALLEL_THRESHOLD:
+        return function(*keys, items)
+    loop = asyncio.get_running_loop()
+    size = max(
+        config.CRYPTO_MIN_CHUNK_SIZE,
+        -(-len(items) // config.CRYPTO_WORKERS),
+    )
+    chunks = await asyncio.gather(*(loop.run_in_executor(
+        app["crypto.executor"],
+        function,
+        *keys,
+        items[start:start + size],
+    ) for start in range(0, len(items), size)))
+    return [result for chunk in chunks for result in chunk]
+
+
+async def encrypt(
+    app: web.Application,
+    key: bytes,
+    passwords: t.Sequence[str],
+) -> t.List[t.Tuple[bytes, bytes]]:
+    """Encrypt passwords, returning each with its nonce."""
+    with metrics.CRYPTO_SECONDS.time("encrypt"):
+        return await _run(app, _encrypt_chunk, (key, ), passwords)
+
+
+async def decrypt(
+    app: web.Application,
+    key: bytes,
+    rows: t.Sequence,
+) -> t.List[t.Dict[str, str]]:
+    """Decrypt stored identifiers."""
+    with metrics.CRYPTO_SECONDS.time("decrypt"):
+        return await _run(app, _decrypt_chunk, (key, ), rows)
+
+
+async def rekey(
+    app: web.Application,
+    old_key: bytes,
+    new_key: bytes,
+    rows: t.Sequence,
+) -> t.List[t.Tuple[str, str, bytes]]:
+    """Re-encrypt stored identifiers under a new key."""
+    with metrics.CRYPTO_SECONDS.time("rekey"):
+        return await _run(app, _rekey_chunk, (old_key, new_key), rows)
+
+
+async def startup(app: web.Application) -> None:
+    """Start the encryption thread pool."""
+    app["crypto.executor"] = ThreadPoolExecutor(
+        max_workers=config.CRYPTO_WORKERS,
+        thread_name_prefix="crypto",
+    )
+
+
+async def cleanup(app: web.Application) -> None:
+    """Shut the encryption thread pool down."""
+    app["crypto.executor"].shutdown(wait=False, cancel_futures=True)
@@ -3,18 +3,173 @@
 Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
+import asyncio
+import logging
+import typing as t
+from time import perf_counter
+
 import asyncpg
+from aiohttp import web
+from aiohttp_session import get_session
+
+from . import audit, config, memory, metrics, queries, schema
+from .responses import Failure, json_response
+from .utils import ADMIN_REQUIRED, authenticated
+
+logger = logging.getLogger(__name__)
+
+
+class Pool:
+    """Pool of connections, bounding and measuring the wait for one.
+
+    Acquiring a connection fails with a 503 once the timeout is reached,
+    rather than queueing requests behind a saturated database.
+    """
+    def __init__(self, pool: t.Union[asyncpg.Pool, memory.Pool],
+                 timeout: float) -> None:
+        """Wrap an asyncpg pool, or an in-memory one."""
+        self.timeout = timeout
+        self.waiting = 0
+        self._pool = pool
+        # Error returned when no connection freed up in time
+        self._exhausted = Failure(
+            web.HTTPServiceUnavailable,
+            "Database busy",
+            "pool_exhausted",
+            headers={"Retry-After": str(max(1, round(timeout)))},
+        )
+
+    def acquire(self) -> "Acquire":
+        """Get a connection, to use with async with."""
+        return Acquire(self)
+
+    async def connect(
+            self) -> t.Union[asyncpg.Connection, memory.Connection]:
+        """Open a connection outside the pool, to listen on."""
+        if isinstance(self._pool, memory.Pool):
+            return await self._pool.connect()
+        return await asyncpg.connect(**config.POSTGRESQL)
+
+    async def close(self) -> None:
+        """Close all the connections."""
+        await self._pool.close()
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        """Get the state of the pool, and the waits so far."""
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        waits = metrics.POOL_WAIT_SECONDS.snapshot()
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "waiting": self.waiting,
+            "acquired": waits["count"],
+            "timeouts": metrics.POOL_TIMEOUTS.values.get((), 0),
+            "wait_seconds": waits,
+        }
+
 
-from . import config
+class Acquire:
+    """Connection acquired from a pool for the duration of a block."""
+
+    __slots__ = ("pool", "connection")
+
+    def __init__(self, pool: Pool) -> None:
+        """Initialize the context manager."""
+        self.pool = pool
+        self.connection: t.Optional[asyncpg.Connection] = None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        """Wait for a connection, failing with a 503 after the timeout."""
+        pool = self.pool
+        start = perf_counter()
+        pool.waiting += 1
+        try:
+            self.connection = await pool._pool.acquire(timeout=pool.timeout)
+        except asyncio.TimeoutError:
+            metrics.POOL_TIMEOUTS.inc()
+            raise pool._exhausted() from None
+        finally:
+            pool.waiting -= 1
+        metrics.POOL_WAIT_SECONDS.observe(perf_counter() - start)
+        return self.connection
+
+    async def __aexit__(self, *_) -> None:
+        """Give the connection back."""
+        await self.pool._pool.release(self.connection)
+
+
+async def prepare_schema() -> None:
+    """Migrate the database if enabled, and check its indexes."""
+    database = await asyncpg.connect(**config.POSTGRESQL)
+    try:
+        if config.AUTO_MIGRATE:
+            await schema.migrate(database)
+        for index in await schema.check(database):
+            logger.warning("Missing %s, lookups may scan the whole table",
+                           index)
+    finally:
+        await database.close()
 
 
 async def startup(app) -> None:
-    """Create the database on startup."""
-    app["asyncpg.pool"] = await asyncpg.create_pool(min_size=2,
-                                                    max_size=1000,
-                                                    **config.POSTGRESQL)
+    """Create the database on startup, and start the audit log."""
+    if config.DATABASE_BACKEND == "memory":
+        app["asyncpg.pool"] = Pool(memory.Pool(config.POOL_MAX_SIZE),
+                                   config.POOL_ACQUIRE_TIMEOUT)
+    else:
+        # Before the pool, as its connections prepare statements on the schema
+        await prepare_schema()
+        app["asyncpg.pool"] = await create_pool()
+    if config.AUDIT:
+        app["audit.log"] = audit.AuditLog(app["asyncpg.pool"])
+        app["audit.log"].start()
+
+
+async def create_pool() -> Pool:
+    """Create the pool of Postgres connections."""
+    return Pool(
+        await asyncpg.create_pool(
+            min_size=config.POOL_MIN_SIZE,
+            max_size=config.POOL_MAX_SIZE,
+            max_queries=config.POOL_MAX_QUERIES,
+            max_inactive_connection_lifetime=(
+                config.POOL_MAX_INACTIVE_LIFETIME),
+            command_timeout=config.POOL_COMMAND_TIMEOUT,
+            server_settings={
+                "statement_timeout": config.STATEMENT_TIMEOUT,
+                # The threshold of the % operator, as in the cached search
+                "pg_trgm.similarity_threshold": str(config.SEARCH_SIMILARITY),
+            },
+            connection_class=queries.Connection,
+            init=queries.init,
+            **config.POSTGRESQL,
+        ),
+        config.POOL_ACQUIRE_TIMEOUT,
+    )
 
 
 async def cleanup(app) -> None:
-    """Cleanup the database connection."""
+    """Write the pending audit events, and close the database connection."""
+    if config.AUDIT:
+        await app["audit.log"].close()
     await app["asyncpg.pool"].close()
+
+
+@authenticated
+async def stats(request: web.Request) -> web.Response:
+    """Get the state of the database connection pool.
+
+    Reserved to admins. Waits are in seconds, and the histogram buckets
+    are cumulative.
+    """
+    session = await get_session(request)
+    if not session["admin"]:
+        raise ADMIN_REQUIRED()
+    return json_response(request, {
+        "success": True,
+        "pool": request.app["asyncpg.pool"].stats(),
+    })
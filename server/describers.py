@@ -3,39 +3,81 @@
 Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
-from aiohttp import web
+import typing as t
+from hashlib import blake2b
+
+from aiohttp import hdrs, web
+from aiohttp.web_response import ContentCoding
 
 from . import __version__, version_info
-from .utils import get_subroutes
+from .responses import dumps, negotiate, precompress
+from .utils import get_subroutes, not_modified
 
+# Body and ETag of a coding of a description
+Variant = t.Tuple[bytes, str]
 
-async def root(request: web.Request) -> web.Response:
-    """Serve information regarding this API."""
-    return web.json_response({
-        "success": True,
+DESCRIPTIONS = {
+    "/": {
         "description": "Self-hosted password manager",
         "version": __version__,
         "version_info": version_info._asdict(),
-        "subroutes": get_subroutes("/", request.app),
-    })
+    },
+    "/user": {
+        "description": "Manage users",
+    },
+    "/identifiers": {
+        "description": "Manage identifiers",
+    },
+}
+
+
+async def startup(app: web.Application) -> None:
+    """Serialize and compress the descriptions once the routes are frozen.
+
+    Each coding of a description has its own ETag.
+    """
+    cache: t.Dict[str, t.Dict[t.Optional[ContentCoding], Variant]] = {}
+    for path, description in DESCRIPTIONS.items():
+        body = dumps({
+            "success": True,
+            **description,
+            "subroutes": get_subroutes(path, app),
+        })
+        etag = blake2b(body, digest_size=16).hexdigest()
+        cache[path] = {
+            coding: (variant, f"{etag}-{coding.value}" if coding else etag)
+            for coding, variant in precompress(body).items()
+        }
+    app["describers.cache"] = cache
+
+
+def serve(request: web.Request, path: str) -> web.Response:
+    """Serve a cached description, unless the client already has it."""
+    variants = request.app["describers.cache"][path]
+    coding = negotiate(request) if len(variants) > 1 else None
+    body, etag = variants.get(coding, variants[None])
+    if not_modified(request, etag):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=body, content_type="application/json")
+        if coding is not None:
+            response.headers[hdrs.CONTENT_ENCODING] = coding.value
+    if len(variants) > 1:
+        response.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    response.etag = etag
+    return response
+
+
+async def root(request: web.Request) -> web.Response:
+    """Serve information regarding this API."""
+    return serve(request, "/")
 
 
 async def user(request: web.Request) -> web.Response:
     """Serve information regarding the user route."""
-    return web.json_response({
-        "success": True,
-        "description": "Manage users",
-        "subroutes": get_subroutes("/user", request.app),
-    })
+    return serve(request, "/user")
 
 
 async def identifiers(request: web.Request) -> web.Response:
     """Serve information regarding the identifiers route."""
-    return web.json_response({
-        "success":
-        True,
-        "description":
-        "Manage identifiers",
-        "subroutes":
-        get_subroutes("/identifiers", request.app),
-    })
+    return serve(request, "/identifiers")
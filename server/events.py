@@ -0,0 +1,218 @@
+"""Change events, fanned out to the watching clients.
+
+Writes publish events on a Postgres channel, or in process with the memory
+backend. Each process listens on a dedicated connection, and forwards the
+events of a user to its WebSockets, gathering those of a burst into a
+single message.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import json
+import logging
+import typing as t
+
+import asyncpg
+from aiohttp import WSCloseCode, web
+
+from . import config, queries
+
+logger = logging.getLogger(__name__)
+
+
+class Hub:
+    """WebSockets of this process, by user, and the events due to them."""
+    def __init__(self, app: web.Application) -> None:
+        """Initialize the hub."""
+        self.app = app
+        self.sockets: t.Dict[int, t.Set[web.WebSocketResponse]] = {}
+        # Kinds of the events received for each user, not sent yet
+        self.pending: t.Dict[int, t.Set[str]] = {}
+        # Last revision sent to the WebSockets of each user
+        self.revisions: t.Dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: t.List[asyncio.Task] = []
+        # Cached sessions to keep up to date with the other processes
+        storage = app["session.storage"]
+        self.sessions = storage if getattr(storage, "shared", False) else None
+
+    def start(self) -> None:
+        """Start listening, and dispatching the events."""
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._dispatch()),
+        ]
+
+    async def stop(self) -> None:
+        """Stop listening."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self) -> None:
+        """Close all the WebSockets, for the server to shut down."""
+        await asyncio.gather(*(socket.close(
+            code=WSCloseCode.GOING_AWAY,
+            message=b"Server shutdown",
+        ) for sockets in self.sockets.values() for socket in sockets))
+
+    def subscribe(self, user_id: int, socket: web.WebSocketResponse) -> None:
+        """Send the events of a user to a WebSocket."""
+        self.sockets.setdefault(user_id, set()).add(socket)
+
+    def unsubscribe(self, user_id: int,
+                    socket: web.WebSocketResponse) -> None:
+        """Stop sending events to a WebSocket."""
+        sockets = self.sockets.get(user_id, set())
+        sockets.discard(socket)
+        if not sockets:
+            self.sockets.pop(user_id, None)
+            self.revisions.pop(user_id, None)
+
+    def received(self, connection: t.Any, pid: int, channel: str,
+                 payload: str) -> None:
+        """Handle a notification."""
+        try:
+            user_id, kind = payload.split(":", 1)
+            user_id = int(user_id)
+        except ValueError:
+            logger.warning("Malformed event %r", payload)
+            return
+        # The vault may have been written by another process
+        self.app["vault.cache"].invalidate(user_id)
+        if user_id in self.sockets:
+            self.pending.setdefault(user_id, set()).add(kind)
+            self._wakeup.set()
+
+    def session_received(self, connection: t.Any, pid: int, channel: str,
+                         payload: str) -> None:
+        """Drop the sessions written or revoked by another process."""
+        try:
+            if payload.startswith("user:"):
+                _, user_id, keep = payload.split(":")
+                self.sessions.forget_user(int(user_id),
+                                          bytes.fromhex(keep) or None)
+            else:
+                self.sessions.forget(bytes.fromhex(payload))
+        except ValueError:
+            logger.warning("Malformed session event %r", payload)
+
+    def _resync(self) -> None:
+        """Check the vaults of every user watching, after missing events."""
+        for user_id in self.sockets:
+            self.app["vault.cache"].invalidate(user_id)
+            self.pending.setdefault(user_id, set()).add("changed")
+        self._wakeup.set()
+
+    async def _listen(self) -> None:
+        """Keep a connection listening for events, reopening it if lost."""
+        lost = False
+        while True:
+            try:
+                connection = await self.app["asyncpg.pool"].connect()
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(queries.EVENTS_CHANNEL,
+                                              self.received)
+                if self.sessions is not None:
+                    await connection.add_listener(queries.SESSIONS_CHANNEL,
+                                                  self.session_received)
+            except (OSError, asyncio.TimeoutError,
+                    asyncpg.PostgresError) as error:
+                logger.warning("Cannot listen for events: %s", error)
+                lost = True
+                await asyncio.sleep(config.WATCH_RECONNECT_DELAY)
+                continue
+            if lost:
+                self._resync()
+            if self.sessions is not None:
+                self.sessions.set_caching(True)
+            try:
+                await closed.wait()
+            finally:
+                if self.sessions is not None:
+                    self.sessions.set_caching(False)
+                await connection.close()
+            logger.warning("Lost the connection listening for events")
+            lost = True
+            await asyncio.sleep(config.WATCH_RECONNECT_DELAY)
+
+    async def _dispatch(self) -> None:
+        """Send the pending events, a burst at a time."""
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(config.WATCH_COALESCE_DELAY)
+            self._wakeup.clear()
+            pending, self.pending = self.pending, {}
+            for user_id, kinds in pending.items():
+                try:
+                    await self._send(user_id, kinds)
+                # Still send the events of the other users
+                except Exception:
+                    logger.exception("Cannot send the events of user %s",
+                                     user_id)
+
+    async def _send(self, user_id: int, kinds: t.Set[str]) -> None:
+        """Send a user's events to its WebSockets."""
+        if "password" in kinds:
+            # The vault key changed: the clients have to log in again
+            await self.broadcast(user_id, {"event": "password"})
+            await asyncio.gather(*(socket.close(
+                code=WSCloseCode.POLICY_VIOLATION,
+                message=b"Password changed",
+            ) for socket in self.sockets.get(user_id, ())))
+            return
+        if user_id not in self.sockets:
+            return
+        async with self.app["asyncpg.pool"].acquire() as database:
+            revision = await database.fetchval(queries.VAULT_VERSION, user_id)
+        # Unless an event was missed, the revision might not have changed
+        if self.revisions.get(user_id) != revision:
+            self.revisions[user_id] = revision
+            await self.broadcast(user_id, {
+                "event": "changed",
+                "revision": revision
+            })
+
+    async def broadcast(self, user_id: int, event: t.Dict[str,
+                                                          t.Any]) -> None:
+        """Send an event to the WebSockets of a user."""
+        message = json.dumps(event)
+        await asyncio.gather(*(self._deliver(socket, message)
+                               for socket in self.sockets.get(user_id, ())))
+
+    async def _deliver(self, socket: web.WebSocketResponse,
+                       message: str) -> None:
+        """Send a message to a WebSocket, closing it if it is too slow."""
+        try:
+            await asyncio.wait_for(socket.send_str(message),
+                                   config.WATCH_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            await socket.close(code=WSCloseCode.TRY_AGAIN_LATER,
+                               message=b"Too slow")
+        except ConnectionError:
+            pass
+
+
+async def publish(database: asyncpg.Connection, user_id: int,
+                  kind: str) -> None:
+    """Publish an event, delivered once the transaction commits."""
+    await database.execute(queries.PUBLISH, queries.EVENTS_CHANNEL,
+                           f"{user_id}:{kind}")
+
+
+async def startup(app: web.Application) -> None:
+    """Start listening for events."""
+    app["events.hub"] = Hub(app)
+    app["events.hub"].start()
+
+
+async def shutdown(app: web.Application) -> None:
+    """Close the WebSockets, which would hold the shutdown."""
+    await app["events.hub"].close()
+
+
+async def cleanup(app: web.Application) -> None:
+    """Stop listening for events."""
+    await app["events.hub"].stop()
@@ -4,75 +4,350 @@ Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
 import json
-from os import urandom
+import typing as t
+from hashlib import blake2b
 
+import asyncpg
 from aiohttp import web
+from aiohttp.helpers import ETag
 from aiohttp_session import get_session
-from Cryptodome.Cipher import AES
 
-from . import config
-from .utils import authenticated, optional, required
+from . import audit, config, crypto, metrics, queries
+from .responses import Failure, compress, dumps, failure, json_response
+from .search import SearchIndex
+from .utils import (authenticated, compile_validator, get_json, not_modified,
+                    optional, parse_copy_row, required)
+
+MALFORMED_CURSOR = Failure(web.HTTPBadRequest, "Malformed cursor",
+                           "malformed_cursor")
+INVALID_REVISION = Failure(web.HTTPBadRequest, "Invalid revision",
+                           "invalid_revision")
+RECORD_EXISTS = Failure(web.HTTPBadRequest, "Record already exists",
+                        "record_exists")
+UNKNOWN_RECORD = Failure(web.HTTPBadRequest, "Record does not exist",
+                         "unknown_record")
 
 
 @authenticated
-@optional(context=str, username=str)
-async def get(request: web.Request) -> web.Response:
+@optional(context=str, username=str, limit=int, after=dict, stream=bool)
+async def get(request: web.Request) -> web.StreamResponse:
     """Get identifiers, optionally filtered by context and username.
 
+    Identifiers are sorted by context and username. When a limit is given
+    and reached, "next" holds the cursor to pass as "after" to get the
+    following page. With stream set, the response is sent in chunks as
+    the rows are read. The ETag changes whenever the identifiers do, so
+    that polling with If-None-Match is answered without reading them.
+
     Optional arguments:
     - context: string
     - username: string
+    - limit: integer
+    - after: object (context and username of the last identifier seen)
+    - stream: boolean (default: false)
     """
     session = await get_session(request)
+    data = await get_json(request)
+
+    args: t.List[t.Any] = [session["id"]]
+    for name in ("context", "username"):
+        if name in data:
+            args.append(data[name])
+
+    if "after" in data:
+        after = data["after"]
+        if not (isinstance(after.get("context"), str)
+                and isinstance(after.get("username"), str)):
+            raise MALFORMED_CURSOR()
+        args += [after["context"], after["username"]]
+
+    limit = data.get("limit")
+    if limit is not None:
+        if not 0 < limit <= config.GET_MAX_LIMIT:
+            raise failure(
+                web.HTTPBadRequest,
+                f"Limit must be between 1 and {config.GET_MAX_LIMIT}",
+                "invalid_limit",
+            )
+        args.append(limit)
+
+    query = queries.select_identifiers(
+        context="context" in data,
+        username="username" in data,
+        after="after" in data,
+        limit=limit is not None,
+    )
 
     async with request.app["asyncpg.pool"].acquire() as database:
-        if await request.text() != "":
-            data = await request.json()
-            if "context" in data:
-                if "username" in data:
-                    rows = await database.fetch(
-                        "SELECT * FROM identifiers WHERE id=$1 AND context=$2 AND username=$3",
-                        session["id"],
-                        data["context"],
-                        data["username"],
-                    )
-                else:
-                    rows = await database.fetch(
-                        "SELECT * FROM identifiers WHERE id=$1 AND context=$2",
-                        session["id"],
-                        data["context"],
-                    )
-            elif "username" in data:
-                rows = await database.fetch(
-                    "SELECT * FROM identifiers WHERE id=$1 AND username=$3",
-                    session["id"],
-                    data["username"],
-                )
-            else:
-                rows = await database.fetch(
-                    "SELECT * FROM identifiers WHERE id=$1",
-                    session["id"],
-                )
-        else:
+        version = await database.fetchval(queries.VAULT_VERSION,
+                                          session["id"])
+    etag = vault_etag(version, data)
+    if not_modified(request, etag.value):
+        response = web.Response(status=304)
+        response.etag = etag
+        return response
+
+    if data.get("stream", False):
+        return await stream(request, session, limit, query, args, etag)
+
+    cache = request.app["vault.cache"]
+    rows = None
+    # The database collation orders the pages, which Python cannot compare
+    if "after" not in data:
+        rows = cache.get(session["id"], version)
+    decrypted = cache.plaintext
+    if rows is not None:
+        rows = filter_rows(rows, data, limit)
+    else:
+        generation = cache.generation(session["id"])
+        async with request.app["asyncpg.pool"].acquire() as database:
+            rows = await database.fetch(query, *args)
+        decrypted = False
+        if len(args) == 1:  # The whole vault was read
+            if cache.plaintext:
+                rows = await crypto.decrypt(request.app, session["password"],
+                                            rows)
+                decrypted = True
+            cache.put(session["id"], rows, generation, version)
+
+    response = json_response(request, {
+        "success":
+        True,
+        "result":
+        rows if decrypted else await crypto.decrypt(
+            request.app, session["password"], rows),
+        "next":
+        next_cursor(rows[-1] if rows else None, len(rows), limit),
+    })
+    response.etag = etag
+    return response
+
+
+def vault_etag(version: int, data: t.Dict[str, t.Any]) -> ETag:
+    """Tag a response of identifiers/get by vault version and filters.
+
+    The tag is weak, as it covers the compressed responses too.
+    """
+    filters = json.dumps(
+        [data.get(name) for name in ("context", "username", "after", "limit")],
+        sort_keys=True,
+    )
+    digest = blake2b(bytes(filters, "utf8"), digest_size=8).hexdigest()
+    return ETag(value=f"{version}-{digest}", is_weak=True)
+
+
+def filter_rows(
+    rows: t.List[t.Any],
+    data: t.Dict[str, t.Any],
+    limit: t.Optional[int],
+) -> t.List[t.Any]:
+    """Select the sorted rows matching the filters of identifiers/get.
+
+    The cursor is not supported, the rows being sorted by the database.
+    """
+    context = data.get("context")
+    username = data.get("username")
+    result = []
+    for row in rows:
+        if ((context is None or row["context"] == context)
+                and (username is None or row["username"] == username)):
+            result.append(row)
+            if len(result) == limit:
+                break
+    return result
+
+
+def next_cursor(
+    row,
+    count: int,
+    limit: t.Optional[int],
+) -> t.Optional[t.Dict[str, str]]:
+    """Get the cursor of the next page, if there may be one."""
+    if row is None or limit is None or count < limit:
+        return None
+    return {"context": row["context"], "username": row["username"]}
+
+
+async def stream(
+    request: web.Request,
+    session,
+    limit: t.Optional[int],
+    query: str,
+    args: t.List[t.Any],
+    etag: ETag,
+) -> web.StreamResponse:
+    """Send the identifiers as chunked JSON, reading them with a cursor."""
+    response = web.StreamResponse()
+    response.content_type = "application/json"
+    response.etag = etag
+    response.enable_chunked_encoding()
+    compress(request, response)
+
+    row = None
+    count = 0
+    async with request.app["asyncpg.pool"].acquire() as database:
+        async with database.transaction():
+            # Errors can no longer be sent once the response is prepared
+            cursor = await database.cursor(query, *args)
+            await response.prepare(request)
+            await response.write(b'{"success":true,"result":[')
+            while chunk := await cursor.fetch(config.STREAM_PREFETCH):
+                row = chunk[-1]
+                rows = await crypto.decrypt(request.app, session["password"],
+                                            chunk)
+                with metrics.JSON_SECONDS.time():
+                    # The elements of the encoded array
+                    result = dumps(rows)[1:-1]
+                await response.write(b"," * bool(count) + result)
+                count += len(chunk)
+
+    await response.write(b'],"next":' + dumps(next_cursor(row, count, limit)) +
+                         b"}")
+    await response.write_eof()
+    return response
+
+
+@authenticated
+async def changes(request: web.Request) -> web.Response:
+    """Get the identifiers written or removed after a revision.
+
+    The "since" query parameter is the revision returned by the previous
+    sync, 0 (the default) to get every identifier. "result" holds the
+    identifiers written, and "removed" the context and username of the
+    removed ones, to apply first. "revision" is the one to pass next time,
+    and "more" tells whether further changes are pending.
+    """
+    session = await get_session(request)
+
+    try:
+        since = int(request.query.get("since", 0))
+    except ValueError:
+        since = -1
+    if since < 0:
+        raise INVALID_REVISION()
+
+    async with request.app["asyncpg.pool"].acquire() as database:
+        rows = await database.fetch(
+            queries.SELECT_CHANGES,
+            session["id"],
+            since,
+            config.CHANGES_PAGE_SIZE,
+        )
+    return json_response(request, {
+        "success":
+        True,
+        "result":
+        await crypto.decrypt(
+            request.app,
+            session["password"],
+            [row for row in rows if row["nonce"] is not None],
+        ),
+        "removed": [{
+            "context": row["context"],
+            "username": row["username"],
+        } for row in rows if row["nonce"] is None],
+        "revision":
+        rows[-1]["revision"] if rows else since,
+        "more":
+        len(rows) == config.CHANGES_PAGE_SIZE,
+    })
+
+
+@authenticated
+async def watch(request: web.Request) -> web.WebSocketResponse:
+    """Get notified of the writes to your identifiers, over a WebSocket.
+
+    The server sends {"event": "changed", "revision": ...} on connection,
+    then after each burst of writes, with the revision of the identifiers,
+    to fetch the changes through identifiers/changes. {"event":
+    "password"} tells that the password changed: the WebSocket is closed,
+    and the client has to log in again.
+    """
+    session = await get_session(request)
+    socket = web.WebSocketResponse(heartbeat=config.WATCH_HEARTBEAT)
+
+    hub = request.app["events.hub"]
+    try:
+        # Before the handshake, for errors to be sent as responses
+        async with request.app["asyncpg.pool"].acquire() as database:
+            await socket.prepare(request)
+            # Before reading the revision, not to miss a write in between
+            hub.subscribe(session["id"], socket)
+            revision = await database.fetchval(queries.VAULT_VERSION,
+                                               session["id"])
+        await socket.send_json({"event": "changed", "revision": revision})
+        # Only control frames are expected from the client
+        async for _ in socket:
+            pass
+    finally:
+        hub.unsubscribe(session["id"], socket)
+    return socket
+
+
+@authenticated
+@required(query=str)
+@optional(fuzzy=bool, limit=int)
+async def search(request: web.Request) -> web.Response:
+    """Search identifiers by the start of their context or username.
+
+    The case-insensitive prefix matches come first, sorted by context and
+    username. With fuzzy set, they are followed by the identifiers whose
+    context or username is similar to the query, the closest first. Each
+    result has a score, 1 for prefix matches.
+
+    Required arguments:
+    - query: string
+
+    Optional arguments:
+    - fuzzy: boolean (default: false)
+    - limit: integer
+    """
+    session = await get_session(request)
+    data = await get_json(request)
+
+    limit = data.get("limit", config.SEARCH_LIMIT)
+    if not 0 < limit <= config.SEARCH_MAX_LIMIT:
+        raise failure(
+            web.HTTPBadRequest,
+            f"Limit must be between 1 and {config.SEARCH_MAX_LIMIT}",
+            "invalid_limit",
+        )
+    fuzzy = data.get("fuzzy", False)
+
+    cache = request.app["vault.cache"]
+    index = None
+    if cache.max_bytes:
+        # Catch the writes handled by other processes, as get does
+        async with request.app["asyncpg.pool"].acquire() as database:
+            version = await database.fetchval(queries.VAULT_VERSION,
+                                              session["id"])
+        index = cache.index(session["id"], SearchIndex, version)
+    decrypted = cache.plaintext
+    if index is not None:
+        matches = index.search(data["query"], fuzzy, limit)
+    else:
+        query = data["query"].lower()
+        async with request.app["asyncpg.pool"].acquire() as database:
             rows = await database.fetch(
-                "SELECT * FROM identifiers WHERE id=$1",
+                queries.SEARCH_FUZZY if fuzzy else queries.SEARCH_PREFIX,
                 session["id"],
+                query,
+                query + "\U0010ffff",
+                limit,
             )
-    return web.json_response({
+        matches = [(row, row["score"]) for row in rows]
+        decrypted = False
+
+    rows = [row for row, _ in matches]
+    if not decrypted:
+        rows = await crypto.decrypt(request.app, session["password"], rows)
+    return json_response(request, {
         "success":
         True,
-        "result": [{
-            "context":
-            row["context"],
-            "username":
-            row["username"],
-            "password":
-            AES.new(
-                session["password"],
-                AES.MODE_EAX,
-                nonce=row["nonce"],
-            ).decrypt(row["password"]),
-        } for row in rows],
+        "result": [
+            dict(row, score=score)
+            for row, (_, score) in zip(rows, matches)
+        ],
     })
 
 
@@ -87,40 +362,25 @@ async def insert(request: web.Request) -> web.Response:
     - password: string
     """
     session = await get_session(request)
-    data = await request.json()
-
-    nonce = urandom(config.NONCE_LENGTH)
+    data = await get_json(request)
 
     async with request.app["asyncpg.pool"].acquire() as database:
         row = await database.fetchrow(
-            "SELECT * FROM identifiers WHERE id=$1 AND context=$2 AND username=$3",
+            queries.INSERT_IDENTIFIER,
             session["id"],
             data["context"],
             data["username"],
+            *crypto.encrypt_one(session["password"], data["password"]),
         )
-        if row:
-            raise web.HTTPBadRequest(
-                reason="Record already exists",
-                text=json.dumps(
-                    {
-                        "success": False,
-                        "msg": "Record already exists",
-                        "error_code": "record_exists",
-                    }, ),
-            )
-        await database.execute(
-            "INSERT INTO identifiers VALUES ($1, 2, $3, $4, $5)",
-            session["id"],
-            data["context"],
-            data["username"],
-            AES.new(
-                session["password"],
-                AES.MODE_EAX,
-                nonce=nonce,
-            ).encrypt(data["password"]),
-            nonce,
-        )
-    return web.json_response({"success": True})
+    if not row:
+        raise RECORD_EXISTS()
+    request.app["vault.cache"].invalidate(session["id"])
+    await audit.record(request,
+                       "identifier_inserted",
+                       session["id"],
+                       context=data["context"],
+                       username=data["username"])
+    return json_response(request, {"success": True})
 
 
 @authenticated
@@ -134,41 +394,25 @@ async def update(request: web.Request) -> web.Response:
     - password: string
     """
     session = await get_session(request)
-    data = await request.json()
-
-    nonce = urandom(config.NONCE_LENGTH)
+    data = await get_json(request)
 
     async with request.app["asyncpg.pool"].acquire() as database:
         row = await database.fetchrow(
-            "SELECT * FROM identifiers WHERE id=$1 AND context=$2 AND username=$3",
+            queries.UPDATE_IDENTIFIER,
             session["id"],
             data["context"],
             data["username"],
+            *crypto.encrypt_one(session["password"], data["password"]),
         )
-        if not row:
-            raise web.HTTPBadRequest(
-                reason="Record does not exist",
-                text=json.dumps(
-                    {
-                        "success": False,
-                        "msg": "Record does not exist",
-                        "error_code": "unknown_record",
-                    }, ),
-            )
-        await database.execute(
-            "UPDATE identifiers SET password=$1, nonce=$2 WHERE "
-            "id=$3 AND context=$4 AND username=$5",
-            AES.new(
-                session["password"],
-                AES.MODE_EAX,
-                nonce=nonce,
-            ).encrypt(data["password"]),
-            nonce,
-            session["id"],
-            data["context"],
-            data["username"],
-        )
-    return web.json_response({"success": True})
+    if not row:
+        raise UNKNOWN_RECORD()
+    request.app["vault.cache"].invalidate(session["id"])
+    await audit.record(request,
+                       "identifier_updated",
+                       session["id"],
+                       context=data["context"],
+                       username=data["username"])
+    return json_response(request, {"success": True})
 
 
 @authenticated
@@ -182,25 +426,23 @@ async def upsert(request: web.Request) -> web.Response:
     - password: string
     """
     session = await get_session(request)
-    data = await request.json()
-
-    nonce = urandom(config.NONCE_LENGTH)
+    data = await get_json(request)
 
     async with request.app["asyncpg.pool"].acquire() as database:
         await database.execute(
-            "INSERT INTO identifiers VALUES ($1, 2, $3, $4, $5) "
-            "ON CONFLICT (id, context, username) DO UPDATE SET password=$4 AND nonce=$5",
+            queries.UPSERT_IDENTIFIER,
             session["id"],
             data["context"],
             data["username"],
-            AES.new(
-                session["password"],
-                AES.MODE_EAX,
-                nonce=nonce,
-            ).encrypt(data["password"]),
-            nonce,
+            *crypto.encrypt_one(session["password"], data["password"]),
         )
-    return web.json_response({"success": True})
+    request.app["vault.cache"].invalidate(session["id"])
+    await audit.record(request,
+                       "identifier_upserted",
+                       session["id"],
+                       context=data["context"],
+                       username=data["username"])
+    return json_response(request, {"success": True})
 
 
 @authenticated
@@ -213,13 +455,286 @@ async def remove(request: web.Request) -> web.Response:
     - username: string
     """
     session = await get_session(request)
-    data = await request.json()
+    data = await get_json(request)
 
     async with request.app["asyncpg.pool"].acquire() as database:
-        await database.execute(
-            "DELETE FROM identifiers WHERE id=$1 AND context=$2 AND username=$3",
+        row = await database.fetchrow(
+            queries.REMOVE_IDENTIFIER,
             session["id"],
             data["context"],
             data["username"],
         )
-    return web.json_response({"success": True})
+    if not row:
+        raise UNKNOWN_RECORD()
+    request.app["vault.cache"].invalidate(session["id"])
+    await audit.record(request,
+                       "identifier_removed",
+                       session["id"],
+                       context=data["context"],
+                       username=data["username"])
+    return json_response(request, {"success": True})
+
+
+validate_import = compile_validator(
+    {
+        "context": str,
+        "username": str,
+        "password": str
+    },
+    True,
+)
+
+
+@authenticated
+async def bulk_import(request: web.Request) -> web.Response:
+    """Import identifiers sent as newline-delimited JSON.
+
+    Each line holds an object with the context, username and password of
+    an identifier. The "conflict" query parameter sets what happens to the
+    identifiers that already exist: "fail" (the default) aborts the whole
+    import, "skip" keeps them and "overwrite" replaces them.
+    """
+    session = await get_session(request)
+
+    policy = request.query.get("conflict", config.IMPORT_CONFLICT)
+    if policy not in queries.IMPORT_IDENTIFIERS:
+        raise failure(web.HTTPBadRequest, f"Unknown conflict policy {policy}",
+                      "unknown_policy")
+
+    try:
+        async with request.app["asyncpg.pool"].acquire() as database:
+            async with database.transaction():
+                await database.execute(queries.CREATE_IMPORT_TABLE)
+                batch: t.List[t.Tuple[int, str, str, str]] = []
+                position = 0
+
+                async def flush() -> None:
+                    """Encrypt and copy the pending identifiers."""
+                    encrypted = await crypto.encrypt(
+                        request.app,
+                        session["password"],
+                        [password for *_, password in batch],
+                    )
+                    await database.copy_records_to_table(
+                        "import",
+                        records=[(*pending[:3], *secret)
+                                 for pending, secret in zip(batch, encrypted)],
+                        columns=queries.IMPORT_COLUMNS,
+                    )
+                    batch.clear()
+
+                async for line in request.content:
+                    if not line.strip():
+                        continue
+                    position += 1
+                    try:
+                        data = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        data = None
+                    if not isinstance(data, dict):
+                        raise failure(
+                            web.HTTPBadRequest,
+                            f"Malformed JSON data on line {position}",
+                            "malformed_json",
+                        )
+                    validate_import(data)
+                    batch.append((
+                        position,
+                        data["context"],
+                        data["username"],
+                        data["password"],
+                    ))
+                    if len(batch) == config.IMPORT_CHUNK_SIZE:
+                        await flush()
+                if batch:
+                    await flush()
+                count = await database.fetchval(
+                    queries.IMPORT_IDENTIFIERS[policy],
+                    session["id"],
+                )
+    except asyncpg.UniqueViolationError:
+        raise RECORD_EXISTS() from None
+    request.app["vault.cache"].invalidate(session["id"])
+    await audit.record(request,
+                       "identifiers_imported",
+                       session["id"],
+                       count=count,
+                       conflict=policy)
+    return json_response(request, {"success": True, "count": count})
+
+
+@authenticated
+async def bulk_export(request: web.Request) -> web.StreamResponse:
+    """Export all identifiers as newline-delimited JSON."""
+    session = await get_session(request)
+
+    response = web.StreamResponse()
+    response.content_type = "application/x-ndjson"
+    response.enable_chunked_encoding()
+    compress(request, response)
+
+    pending = b""
+
+    async def write(chunk: bytes) -> None:
+        """Decrypt the complete rows of a chunk of COPY output."""
+        nonlocal pending
+        *lines, pending = (pending + chunk).split(b"\n")
+        rows = []
+        for line in lines:
+            context, username, password, nonce = parse_copy_row(line)
+            rows.append({
+                "context": context.decode("utf8"),
+                "username": username.decode("utf8"),
+                "password": bytes.fromhex(password[2:].decode()),
+                "nonce": bytes.fromhex(nonce[2:].decode()),
+            })
+        if rows:
+            rows = await crypto.decrypt(request.app, session["password"],
+                                        rows)
+            with metrics.JSON_SECONDS.time():
+                lines = b"".join(dumps(row) + b"\n" for row in rows)
+            await response.write(lines)
+
+    async with request.app["asyncpg.pool"].acquire() as database:
+        # Errors can no longer be sent once the response is prepared
+        await response.prepare(request)
+        await database.copy_from_query(
+            queries.select_identifiers(),
+            session["id"],
+            output=write,
+            format="text",
+        )
+
+    await response.write_eof()
+    return response
+
+
+BATCH_ACTIONS = {
+    "insert": (insert, queries.BATCH_INSERT, "record_exists",
+               "Record already exists"),
+    "update": (update, queries.BATCH_UPDATE, "unknown_record",
+               "Record does not exist"),
+    "upsert": (upsert, queries.UPSERT_IDENTIFIER, None, None),
+    "remove": (remove, queries.BATCH_REMOVE, "unknown_record",
+               "Record does not exist"),
+}
+batch_validators = {
+    action: compile_validator(handler.required, True)
+    for action, (handler, *_) in BATCH_ACTIONS.items()
+}
+
+
+def batch_runs(
+    operations: t.List[t.Dict[str, t.Any]],
+) -> t.Iterator[t.Tuple[str, t.List[int]]]:
+    """Split operations into runs of one action on distinct identifiers.
+
+    Each run can then be applied with a single statement, in order.
+    """
+    action = None
+    run: t.List[int] = []
+    keys: t.Set[t.Tuple[str, str]] = set()
+    for index, operation in enumerate(operations):
+        key = (operation["context"], operation["username"])
+        if operation["action"] != action or key in keys:
+            if run:
+                yield action, run
+            action = operation["action"]
+            run = []
+            keys = set()
+        run.append(index)
+        keys.add(key)
+    if run:
+        yield action, run
+
+
+@authenticated
+@required(operations=list)
+async def batch(request: web.Request) -> web.Response:
+    """Apply several operations at once, in a single transaction.
+
+    Each operation is an object whose "action" is insert, update, upsert or
+    remove, along with the arguments of the matching route. The response
+    holds one result per operation, in order.
+
+    Required arguments:
+    - operations: array
+    """
+    session = await get_session(request)
+    operations = (await get_json(request))["operations"]
+
+    if len(operations) > config.BATCH_MAX_OPERATIONS:
+        raise failure(
+            web.HTTPBadRequest,
+            f"At most {config.BATCH_MAX_OPERATIONS} operations allowed",
+            "batch_too_large",
+        )
+    for index, operation in enumerate(operations):
+        action = operation.get("action") if isinstance(operation,
+                                                       dict) else None
+        if action not in BATCH_ACTIONS:
+            raise failure(
+                web.HTTPBadRequest,
+                f"Unknown action in operation {index}",
+                "unknown_action",
+                index=index,
+            )
+        try:
+            batch_validators[action](operation)
+        except web.HTTPBadRequest as error:
+            details = json.loads(error.body)
+            raise failure(
+                web.HTTPBadRequest,
+                details["msg"],
+                details["error_code"],
+                index=index,
+            ) from None
+
+    results: t.List[t.Dict[str, t.Any]] = [{"success": True}] * len(operations)
+    async with request.app["asyncpg.pool"].acquire() as database:
+        async with database.transaction():
+            for action, run in batch_runs(operations):
+                _, query, error_code, msg = BATCH_ACTIONS[action]
+                contexts = [operations[index]["context"] for index in run]
+                usernames = [operations[index]["username"] for index in run]
+
+                encrypted = []
+                if action != "remove":
+                    encrypted = await crypto.encrypt(
+                        request.app,
+                        session["password"],
+                        [operations[index]["password"] for index in run],
+                    )
+
+                if action == "upsert":
+                    await database.executemany(query, [
+                        (session["id"], context, username, *secret)
+                        for context, username, secret in zip(
+                            contexts, usernames, encrypted)
+                    ])
+                    continue
+
+                args: t.List[t.Any] = [session["id"], contexts, usernames]
+                if encrypted:
+                    args += [list(column) for column in zip(*encrypted)]
+                done = {(row["context"], row["username"])
+                        for row in await database.fetch(query, *args)}
+                for index, context, username in zip(run, contexts,
+                                                    usernames):
+                    if (context, username) not in done:
+                        results[index] = {
+                            "success": False,
+                            "msg": msg,
+                            "error_code": error_code,
+                        }
+    request.app["vault.cache"].invalidate(session["id"])
+    applied = [{
+        "action": operation["action"],
+        "context": operation["context"],
+        "username": operation["username"],
+    } for operation, result in zip(operations, results) if result["success"]]
+    await audit.record(request,
+                       "identifiers_batch",
+                       session["id"],
+                       operations=applied)
+    return json_response(request, {"success": True, "results": results})
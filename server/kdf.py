@@ -0,0 +1,129 @@
+"""Key derivation offloading.
+
+Each password hash is stored with the algorithm and parameters which made
+it, so that the configured ones can change: existing hashes stay valid,
+and are replaced on the next login of their user.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import os
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import pbkdf2_hmac, scrypt
+from time import perf_counter
+
+from aiohttp import web
+
+from . import config, metrics
+
+# Parameters of each algorithm, in their stored order
+ALGORITHMS = {
+    "pbkdf2_sha256": ("iterations", ),
+    "scrypt": ("n", "r", "p"),
+}
+
+
+def hash_password(algorithm: str, parameters: t.Sequence[int],
+                  password: bytes, salt: bytes) -> bytes:
+    """Hash a password, blocking."""
+    if algorithm == "pbkdf2_sha256":
+        iterations, = parameters
+        return pbkdf2_hmac("sha256", password, salt, iterations)
+    if algorithm == "scrypt":
+        n, r, p = parameters
+        return scrypt(
+            password,
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            # The default of 32 MiB is too little for n >= 2 ** 15
+            maxmem=128 * r * (n + p + 2) + 1024 * 1024,
+            dklen=32,
+        )
+    raise ValueError(f"Unknown key derivation function {algorithm}")
+
+
+def outdated(algorithm: str, parameters: t.Sequence[int]) -> bool:
+    """Check whether a hash was made with other than the configured KDF."""
+    return (algorithm != config.KDF_ALGORITHM
+            or tuple(parameters) != tuple(config.KDF_PARAMETERS))
+
+
+def calibrate(algorithm: str, target: float) -> t.Tuple[int, ...]:
+    """Find the parameters of a hash taking about target seconds here.
+
+    PBKDF2 iterations are scaled linearly from a short run. The scrypt cost
+    n is a power of two, doubled while the hash stays under the target and
+    within KDF_MAX_MEMORY, with r = 8 and p = 1.
+    """
+    salt = bytes(config.SALT_LENGTH)
+
+    def measure(parameters: t.Tuple[int, ...]) -> float:
+        """Time the best of three hashes."""
+        times = []
+        for _ in range(3):
+            start = perf_counter()
+            hash_password(algorithm, parameters, b"calibration", salt)
+            times.append(perf_counter() - start)
+        return min(times)
+
+    if algorithm == "pbkdf2_sha256":
+        iterations = 10000
+        # Make the sample long enough to time reliably
+        while (elapsed := measure((iterations, ))) < 0.05:
+            iterations *= 2
+        return (max(1000, int(round(iterations * target / elapsed, -3))), )
+    if algorithm == "scrypt":
+        n = 2**14
+        while (128 * 8 * n * 2 <= config.KDF_MAX_MEMORY
+               and measure((n * 2, 8, 1)) <= target):
+            n *= 2
+        return (n, 8, 1)
+    raise ValueError(f"Unknown key derivation function {algorithm}")
+
+
+def pool_size(workers: int) -> int:
+    """Get the number of hashing processes of each of the server workers.
+
+    They share KDF_WORKERS processes, or one per CPU.
+    """
+    return max(1, (config.KDF_WORKERS or os.cpu_count() or 1) // workers)
+
+
+async def startup(app: web.Application) -> None:
+    """Start the key derivation process pool."""
+    app["kdf.executor"] = ProcessPoolExecutor(
+        max_workers=pool_size(app["workers"]))
+
+
+async def cleanup(app: web.Application) -> None:
+    """Shut the key derivation process pool down."""
+    app["kdf.executor"].shutdown(wait=False, cancel_futures=True)
+
+
+async def derive(
+    app: web.Application,
+    password: str,
+    salt: bytes,
+    algorithm: t.Optional[str] = None,
+    parameters: t.Optional[t.Sequence[int]] = None,
+) -> bytes:
+    """Hash a password in the process pool, without blocking the loop.
+
+    The configured algorithm and parameters are used unless given.
+    """
+    if algorithm is None:
+        algorithm, parameters = config.KDF_ALGORITHM, config.KDF_PARAMETERS
+    with metrics.KDF_SECONDS.time():
+        async with app["admission.kdf"]:
+            return await asyncio.get_running_loop().run_in_executor(
+                app["kdf.executor"],
+                hash_password,
+                algorithm,
+                tuple(parameters),
+                bytes(password, "utf8"),
+                salt,
+            )
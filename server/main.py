@@ -8,35 +8,83 @@ import base64
 from aiohttp import web
 from aiohttp_session import setup
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from cryptography import fernet
 
-from . import config, database, describers, identifiers, session
+from . import (admission, config, crypto, database, describers, events,
+               identifiers, kdf, metrics, session, storage, vault)
 
 
-async def make_app() -> web.Application:
-    """Create the app."""
-    app = web.Application()
+async def make_app(workers: int = 1) -> web.Application:
+    """Create the app, run by one of several workers."""
+    app = web.Application(
+        middlewares=[metrics.middleware] if config.METRICS else [])
+    app["workers"] = workers
 
     app.on_startup.append(database.startup)
     app.on_cleanup.append(database.cleanup)
+    app.on_startup.append(admission.startup)
+    app.on_startup.append(kdf.startup)
+    app.on_startup.append(describers.startup)
+    app.on_startup.append(storage.startup)
+    app.on_startup.append(vault.startup)
+    app.on_cleanup.append(kdf.cleanup)
+    app.on_startup.append(crypto.startup)
+    app.on_cleanup.append(crypto.cleanup)
+    if config.WATCH:
+        app.on_startup.append(events.startup)
+        app.on_shutdown.append(events.shutdown)
+        # Before the database pool is closed
+        app.on_cleanup.insert(0, events.cleanup)
 
-    # secret_key must be 32 url-safe base64-encoded bytes
-    fernet_key = fernet.Fernet.generate_key()
+    fernet_key = storage.load_secret()
     secret_key = base64.urlsafe_b64decode(fernet_key)
-    setup(app,
-          EncryptedCookieStorage(secret_key, cookie_name=config.COOKIE_NAME))
+    if config.SESSION_BACKEND == "cookie":
+        app["session.storage"] = EncryptedCookieStorage(
+            secret_key,
+            cookie_name=config.COOKIE_NAME,
+            max_age=config.SESSION_MAX_AGE,
+            encoder=storage.encode,
+            decoder=storage.decode,
+        )
+    else:
+        persistent = config.SESSION_BACKEND == "postgres"
+        if workers > 1 and not persistent:
+            raise ValueError(
+                "Sessions of the memory backend are not shared between "
+                "workers: use the postgres or cookie backend")
+        app["session.storage"] = storage.ServerStorage(
+            fernet_key,
+            cookie_name=config.COOKIE_NAME,
+            max_age=config.SESSION_MAX_AGE,
+            cache_size=config.SESSION_CACHE_SIZE,
+            persistent=persistent,
+            # The memory tier of a worker has to drop the sessions written
+            # or revoked by the others, which the events hub tells
+            shared=workers > 1,
+        )
+    setup(app, app["session.storage"])
 
     app.add_routes([
         web.get("/", describers.root),
+        web.get("/stats", database.stats),
         web.get("/user", describers.user),
         web.post("/user/login", session.login),
+        web.post("/user/logout", session.logout),
         web.post("/user/password", session.password),
         web.post("/user/create", session.create),
         web.get("/identifiers", describers.identifiers),
         web.get("/identifiers/get", identifiers.get),
+        web.get("/identifiers/search", identifiers.search),
+        web.get("/identifiers/changes", identifiers.changes),
         web.post("/identifiers/insert", identifiers.insert),
         web.put("/identifiers/update", identifiers.update),
         web.post("/identifiers/upsert", identifiers.upsert),
         web.delete("/identifiers/remove", identifiers.remove),
+        web.post("/identifiers/batch", identifiers.batch),
+        web.post("/identifiers/import", identifiers.bulk_import),
+        web.get("/identifiers/export", identifiers.bulk_export),
     ], )
+    if config.WATCH:
+        app.router.add_get("/identifiers/watch", identifiers.watch)
+    if config.METRICS:
+        app.router.add_get("/metrics", metrics.serve)
     return app
@@ -0,0 +1,603 @@
+"""In-memory database backend.
+
+Stands in for the asyncpg pool when config.DATABASE_BACKEND is "memory",
+answering the statements of the queries module the way Postgres would, so
+that the server can run and be benchmarked without a database. Statements
+are atomic, but a failed transaction does not roll back the ones before.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import asyncio
+import typing as t
+from bisect import bisect_left, insort
+from itertools import product
+from time import time
+
+import asyncpg
+
+from . import config, queries
+from .search import similarity, trigrams
+
+Row = t.Dict[str, t.Any]
+Key = t.Tuple[str, str]
+Listener = t.Callable[["Connection", int, str, str], None]
+
+# Rows of COPY output passed to the output callback at once
+COPY_CHUNK_SIZE = 1000
+
+
+class Store:
+    """Tables shared by all the connections."""
+    def __init__(self) -> None:
+        """Create empty tables."""
+        self.users: t.Dict[str, Row] = {}
+        self.users_by_id: t.Dict[int, Row] = {}
+        self.next_user = 1
+        self.revision = 0
+        # Per user id: rows by key, and their sorted keys
+        self.identifiers: t.Dict[int, t.Dict[Key, Row]] = {}
+        self.keys: t.Dict[int, t.List[Key]] = {}
+        self.tombstones: t.Dict[int, t.Dict[Key, int]] = {}
+        # Highest revision of each user's identifiers, tombstones and key
+        self.versions: t.Dict[int, int] = {}
+        self.sessions: t.Dict[bytes, t.Tuple[t.Optional[int], bytes,
+                                             int]] = {}
+        # Tables written with copy_records_to_table, besides temporary ones
+        self.tables: t.Dict[str, t.List[Row]] = {"audit_log": []}
+        # Per channel, the listening connections and their callbacks
+        self.listeners: t.Dict[str, t.List[t.Tuple["Connection",
+                                                   Listener]]] = {}
+
+    def vault(self, user_id: int) -> t.Dict[Key, Row]:
+        """Get a user's identifiers by key."""
+        return self.identifiers.setdefault(user_id, {})
+
+    def revise(self, user_id: int, notify: bool = True) -> int:
+        """Get the next revision, for a write to a user's identifiers."""
+        self.revision += 1
+        self.versions[user_id] = self.revision
+        if notify:
+            self.notify(queries.EVENTS_CHANNEL, f"{user_id}:changed")
+        return self.revision
+
+    def notify(self, channel: str, payload: str) -> None:
+        """Deliver a notification to the listeners, as asyncpg does."""
+        loop = asyncio.get_running_loop()
+        for connection, callback in self.listeners.get(channel, ()):
+            loop.call_soon(callback, connection, 0, channel, payload)
+
+    def insert(self, user_id: int, context: str, username: str,
+               password: bytes, nonce: bytes) -> bool:
+        """Insert an identifier, unless it exists."""
+        vault = self.vault(user_id)
+        key = (context, username)
+        if key in vault:
+            return False
+        vault[key] = {
+            "context": context,
+            "username": username,
+            "password": password,
+            "nonce": nonce,
+            "revision": self.revise(user_id),
+        }
+        insort(self.keys.setdefault(user_id, []), key)
+        return True
+
+    def update(self, user_id: int, context: str, username: str,
+               password: bytes, nonce: bytes) -> bool:
+        """Update an identifier, if it exists."""
+        row = self.vault(user_id).get((context, username))
+        if row is None:
+            return False
+        row.update(password=password,
+                   nonce=nonce,
+                   revision=self.revise(user_id))
+        return True
+
+    def remove(self, user_id: int, context: str, username: str) -> bool:
+        """Remove an identifier, leaving a tombstone."""
+        key = (context, username)
+        if self.vault(user_id).pop(key, None) is None:
+            return False
+        keys = self.keys[user_id]
+        del keys[bisect_left(keys, key)]
+        self.tombstones.setdefault(user_id, {})[key] = self.revise(user_id)
+        return True
+
+    def sorted(self, user_id: int) -> t.Iterator[Row]:
+        """Iterate over a user's identifiers, sorted."""
+        vault = self.vault(user_id)
+        return (vault[key] for key in self.keys.get(user_id, ()))
+
+
+class Cursor:
+    """Cursor over the rows of a query, awaited or iterated."""
+    def __init__(self, rows: t.List[Row]) -> None:
+        """Initialize the cursor."""
+        self._rows = iter(rows)
+
+    def __await__(self) -> t.Generator[t.Any, None, "Cursor"]:
+        """Open the cursor."""
+        return self._open().__await__()
+
+    async def _open(self) -> "Cursor":
+        """Open the cursor."""
+        return self
+
+    async def fetch(self, count: int) -> t.List[Row]:
+        """Get the next rows."""
+        return [row for _, row in zip(range(count), self._rows)]
+
+    def __aiter__(self) -> "Cursor":
+        """Iterate over the rows."""
+        return self
+
+    async def __anext__(self) -> Row:
+        """Get the next row."""
+        try:
+            return next(self._rows)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+
+class Transaction:
+    """Transaction scoping the temporary tables and local settings."""
+    def __init__(self, connection: "Connection") -> None:
+        """Initialize the transaction."""
+        self.connection = connection
+
+    async def __aenter__(self) -> None:
+        """Start the transaction."""
+
+    async def __aexit__(self, *_) -> None:
+        """Drop the temporary tables, and reset the local settings."""
+        self.connection.tables.clear()
+        self.connection.keep_revisions = False
+
+
+class Connection:
+    """Connection running the statements of the queries module."""
+    def __init__(self, store: Store) -> None:
+        """Initialize the connection."""
+        self.store = store
+        self.tables: t.Dict[str, t.List[Row]] = {}
+        self.keep_revisions = False
+
+    def _run(self, query: str, args: t.Sequence[t.Any]) -> t.List[Row]:
+        """Run a statement, returning its rows."""
+        handler = HANDLERS.get(query)
+        if handler is None:
+            raise NotImplementedError(f"Unsupported statement: {query}")
+        return handler(self, *args) or []
+
+    async def fetch(self, query: str, *args, timeout=None) -> t.List[Row]:
+        """Run a query and return the results as a list."""
+        return self._run(query, args)
+
+    async def fetchrow(self, query: str, *args,
+                       timeout=None) -> t.Optional[Row]:
+        """Run a query and return the first row."""
+        rows = self._run(query, args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query: str, *args, column=0, timeout=None):
+        """Run a query and return a value in the first row."""
+        rows = self._run(query, args)
+        return list(rows[0].values())[column] if rows else None
+
+    async def execute(self, query: str, *args, timeout=None) -> str:
+        """Run a statement."""
+        self._run(query, args)
+        return ""
+
+    async def executemany(self, command: str, args, *, timeout=None) -> None:
+        """Run a statement for each set of arguments."""
+        for arguments in args:
+            self._run(command, arguments)
+
+    def transaction(self) -> Transaction:
+        """Start a transaction."""
+        return Transaction(self)
+
+    async def add_listener(self, channel: str, callback: Listener) -> None:
+        """Listen for notifications on a channel."""
+        self.store.listeners.setdefault(channel, []).append((self, callback))
+
+    async def remove_listener(self, channel: str, callback: Listener) -> None:
+        """Stop listening for notifications on a channel."""
+        listeners = self.store.listeners.get(channel, [])
+        if (self, callback) in listeners:
+            listeners.remove((self, callback))
+
+    def add_termination_listener(
+            self, callback: t.Callable[["Connection"], None]) -> None:
+        """Do nothing, as the connection is never lost."""
+
+    async def close(self) -> None:
+        """Stop listening on every channel."""
+        for listeners in self.store.listeners.values():
+            listeners[:] = [(connection, callback)
+                            for connection, callback in listeners
+                            if connection is not self]
+
+    def cursor(self, query: str, *args, prefetch=None) -> Cursor:
+        """Iterate over the results of a query."""
+        return Cursor(self._run(query, args))
+
+    async def copy_records_to_table(
+        self,
+        table_name: str,
+        *,
+        records: t.Iterable[t.Sequence[t.Any]],
+        columns: t.Optional[t.Sequence[str]] = None,
+    ) -> str:
+        """Append records to a table."""
+        if columns is None:
+            columns = ("context", "username", "password")
+        table = self.tables.get(table_name)
+        if table is None:
+            table = self.store.tables[table_name]
+        table.extend(dict(zip(columns, record)) for record in records)
+        return ""
+
+    async def copy_from_query(
+        self,
+        query: str,
+        *args,
+        output: t.Callable[[bytes], t.Awaitable[None]],
+        format: str = "text",
+    ) -> str:
+        """Send the rows of a query in the COPY text format."""
+        if format != "text":
+            raise NotImplementedError(f"Unsupported COPY format: {format}")
+        rows = self._run(query, args)
+        for start in range(0, len(rows), COPY_CHUNK_SIZE):
+            await output("".join(
+                "\t".join(map(_copy_field, row.values())) + "\n"
+                for row in rows[start:start + COPY_CHUNK_SIZE]).encode("utf8"))
+        return ""
+
+    # Users
+
+    def _get_user(self, username: str) -> t.List[Row]:
+        """Get a user by name."""
+        user = self.store.users.get(username)
+        return [dict(user)] if user else []
+
+    def _create_user(self, username: str, password: bytes, salt: bytes,
+                     kdf: str, kdf_params: t.List[int],
+                     admin: bool) -> t.List[Row]:
+        """Create a user, unless the name is taken."""
+        if username in self.store.users:
+            return []
+        user_id = self.store.next_user
+        self.store.next_user += 1
+        self.store.users[username] = self.store.users_by_id[user_id] = {
+            "id": user_id,
+            "password": password,
+            "salt": salt,
+            "kdf": kdf,
+            "kdf_params": kdf_params,
+            "admin": admin,
+        }
+        return [{"id": user_id}]
+
+    def _change_password(self, user_id: int, password: bytes, salt: bytes,
+                         kdf: str, kdf_params: t.List[int]) -> None:
+        """Change the password hash of a user."""
+        user = self.store.users_by_id.get(user_id)
+        if user is not None:
+            user.update(password=password,
+                        salt=salt,
+                        kdf=kdf,
+                        kdf_params=kdf_params)
+
+    def _change_key(self, user_id: int, *args: t.Any) -> None:
+        """Change the password of a user, and so the key of its vault."""
+        if user_id in self.store.users_by_id:
+            self._change_password(user_id, *args)
+            # The password change publishes its own event
+            self.store.revise(user_id, notify=False)
+
+    def _rehash_password(self, user_id: int, previous: bytes,
+                         *args: t.Any) -> None:
+        """Change the password hash of a user, unless it changed already."""
+        user = self.store.users_by_id.get(user_id)
+        if user is not None and user["password"] == previous:
+            self._change_password(user_id, *args)
+
+    # Identifiers
+
+    def _select(self, context: bool, username: bool, after: bool, limit: bool,
+                user_id: int, *args: t.Any) -> t.List[Row]:
+        """Select a user's identifiers, sorted."""
+        values = list(args)
+        wanted_context = values.pop(0) if context else None
+        wanted_username = values.pop(0) if username else None
+        start = (values.pop(0), values.pop(0)) if after else None
+        count = values.pop(0) if limit else None
+        result = []
+        for row in self.store.sorted(user_id):
+            if ((not context or row["context"] == wanted_context)
+                    and (not username or row["username"] == wanted_username)
+                    and (start is None or
+                         (row["context"], row["username"]) > start)):
+                result.append({
+                    name: row[name]
+                    for name in queries.IDENTIFIER_COLUMNS
+                })
+                if len(result) == count:
+                    break
+        return result
+
+    def _insert(self, *args: t.Any) -> t.List[Row]:
+        """Insert an identifier."""
+        return [{"?column?": 1}] if self.store.insert(*args) else []
+
+    def _update(self, *args: t.Any) -> t.List[Row]:
+        """Update an identifier."""
+        return [{"?column?": 1}] if self.store.update(*args) else []
+
+    def _upsert(self, *args: t.Any) -> None:
+        """Insert an identifier, or update it."""
+        if not self.store.insert(*args):
+            self.store.update(*args)
+
+    def _remove(self, *args: t.Any) -> t.List[Row]:
+        """Remove an identifier."""
+        return [{"?column?": 1}] if self.store.remove(*args) else []
+
+    def _changes(self, user_id: int, since: int, limit: int) -> t.List[Row]:
+        """Get the identifiers written or removed after a revision."""
+        rows = [{
+            name: row[name]
+            for name in (*queries.IDENTIFIER_COLUMNS, "revision")
+        } for row in self.store.vault(user_id).values()
+                if row["revision"] > since]
+        rows += [{
+            "context": context,
+            "username": username,
+            "password": None,
+            "nonce": None,
+            "revision": revision,
+        } for (context, username), revision in self.store.tombstones.get(
+            user_id, {}).items() if revision > since]
+        rows.sort(key=lambda row: row["revision"])
+        return rows[:limit]
+
+    def _version(self, user_id: int) -> t.List[Row]:
+        """Get the version of a user's identifiers."""
+        return [{"coalesce": self.store.versions.get(user_id, 0)}]
+
+    def _search(self, fuzzy: bool, user_id: int, low: str, high: str,
+                limit: int) -> t.List[Row]:
+        """Search identifiers by prefix, and by similarity if fuzzy."""
+        searched = trigrams(low)
+        found = []
+        for row in self.store.sorted(user_id):
+            if any(low <= field.lower() < high
+                   for field in (row["context"], row["username"])):
+                score = 1.0
+            elif fuzzy:
+                score = max(
+                    similarity(searched, trigrams(row["context"])),
+                    similarity(searched, trigrams(row["username"])),
+                )
+                if score < config.SEARCH_SIMILARITY:
+                    continue
+            else:
+                continue
+            found.append(
+                {name: row[name]
+                 for name in queries.IDENTIFIER_COLUMNS} | {"score": score})
+        found.sort(key=lambda row: -row["score"])
+        return found[:limit]
+
+    def _publish(self, channel: str, payload: str) -> None:
+        """Publish a notification."""
+        self.store.notify(channel, payload)
+
+    # Bulk work
+
+    def _create_table(self, name: str) -> None:
+        """Create a temporary table, dropped with the transaction."""
+        self.tables[name] = []
+
+    def _keep_revisions(self) -> None:
+        """Keep the revisions of the identifiers updated in the transaction."""
+        self.keep_revisions = True
+
+    def _apply_rekey(self, user_id: int) -> None:
+        """Apply the re-encrypted passwords."""
+        vault = self.store.vault(user_id)
+        for staged in self.tables["rekey"]:
+            row = vault.get((staged["context"], staged["username"]))
+            if row is not None:
+                row["password"] = staged["password"]
+                if not self.keep_revisions:
+                    row["revision"] = self.store.revise(user_id)
+
+    def _import(self, policy: str, user_id: int) -> t.List[Row]:
+        """Insert the imported identifiers, following a conflict policy."""
+        staged = sorted(self.tables["import"], key=lambda row: row["position"])
+        args = [(user_id, row["context"], row["username"], row["password"],
+                 row["nonce"]) for row in staged]
+        count = 0
+        if policy == "fail":
+            vault = self.store.vault(user_id)
+            keys = {(context, username) for _, context, username, *_ in args}
+            if len(keys) < len(args) or any(key in vault for key in keys):
+                raise asyncpg.UniqueViolationError(
+                    "duplicate key value violates unique constraint "
+                    '"identifiers_key"')
+        if policy == "overwrite":
+            # The last occurrence of each identifier wins
+            args = list({tuple(arg[1:3]): arg for arg in args}.values())
+        for arg in args:
+            if self.store.insert(*arg):
+                count += 1
+            elif policy == "overwrite":
+                self.store.update(*arg)
+                count += 1
+        return [{"count": count}]
+
+    def _batch_insert(self, user_id: int, contexts: t.List[str],
+                      usernames: t.List[str], passwords: t.List[bytes],
+                      nonces: t.List[bytes]) -> t.List[Row]:
+        """Insert identifiers, returning those inserted."""
+        return [{
+            "context": context,
+            "username": username
+        } for context, username, password, nonce in zip(
+            contexts, usernames, passwords, nonces) if self.store.insert(
+                user_id, context, username, password, nonce)]
+
+    def _batch_update(self, user_id: int, contexts: t.List[str],
+                      usernames: t.List[str], passwords: t.List[bytes],
+                      nonces: t.List[bytes]) -> t.List[Row]:
+        """Update identifiers, returning those updated."""
+        return [{
+            "context": context,
+            "username": username
+        } for context, username, password, nonce in zip(
+            contexts, usernames, passwords, nonces) if self.store.update(
+                user_id, context, username, password, nonce)]
+
+    def _batch_remove(self, user_id: int, contexts: t.List[str],
+                      usernames: t.List[str]) -> t.List[Row]:
+        """Remove identifiers, returning those removed."""
+        return [{
+            "context": context,
+            "username": username
+        } for context, username in zip(contexts, usernames)
+                if self.store.remove(user_id, context, username)]
+
+    # Persistent sessions
+
+    def _load_session(self, key: bytes) -> t.List[Row]:
+        """Get the data of an unexpired session."""
+        session = self.store.sessions.get(key)
+        if session is None or session[2] <= time():
+            return []
+        return [{"data": session[1]}]
+
+    def _save_session(self, key: bytes, user_id: t.Optional[int], data: bytes,
+                      expires: int) -> None:
+        """Store a session."""
+        self.store.sessions[key] = (user_id, data, expires)
+
+    def _revoke_session(self, key: bytes) -> None:
+        """Delete a session."""
+        self.store.sessions.pop(key, None)
+
+    def _revoke_user_sessions(self, user_id: int,
+                              keep: t.Optional[bytes]) -> None:
+        """Delete the sessions of a user, but one."""
+        for key, session in list(self.store.sessions.items()):
+            if session[0] == user_id and key != keep:
+                del self.store.sessions[key]
+
+    def _purge_sessions(self) -> None:
+        """Delete the expired sessions."""
+        now = time()
+        for key, session in list(self.store.sessions.items()):
+            if session[2] <= now:
+                del self.store.sessions[key]
+
+
+def _bound(function: t.Callable[..., t.Any],
+           *leading: t.Any) -> t.Callable[..., t.Any]:
+    """Fix the first arguments of a method, after the connection."""
+    return lambda connection, *args: function(connection, *leading, *args)
+
+
+# Implementation of each statement, taking the connection and its arguments
+HANDLERS: t.Dict[str, t.Callable[..., t.Optional[t.List[Row]]]] = {
+    queries.GET_USER: Connection._get_user,
+    queries.CREATE_USER: Connection._create_user,
+    queries.CHANGE_PASSWORD: Connection._change_key,
+    queries.REHASH_PASSWORD: Connection._rehash_password,
+    queries.INSERT_IDENTIFIER: Connection._insert,
+    queries.UPDATE_IDENTIFIER: Connection._update,
+    queries.UPSERT_IDENTIFIER: Connection._upsert,
+    queries.REMOVE_IDENTIFIER: Connection._remove,
+    queries.SELECT_CHANGES: Connection._changes,
+    queries.VAULT_VERSION: Connection._version,
+    queries.SEARCH_PREFIX: _bound(Connection._search, False),
+    queries.SEARCH_FUZZY: _bound(Connection._search, True),
+    queries.CREATE_REKEY_TABLE: _bound(Connection._create_table, "rekey"),
+    queries.KEEP_REVISIONS: Connection._keep_revisions,
+    queries.APPLY_REKEY: Connection._apply_rekey,
+    queries.CREATE_IMPORT_TABLE: _bound(Connection._create_table, "import"),
+    queries.BATCH_INSERT: Connection._batch_insert,
+    queries.BATCH_UPDATE: Connection._batch_update,
+    queries.BATCH_REMOVE: Connection._batch_remove,
+    queries.LOAD_SESSION: Connection._load_session,
+    queries.SAVE_SESSION: Connection._save_session,
+    queries.REVOKE_SESSION: Connection._revoke_session,
+    queries.REVOKE_USER_SESSIONS: Connection._revoke_user_sessions,
+    queries.PURGE_SESSIONS: Connection._purge_sessions,
+    queries.PUBLISH: Connection._publish,
+}
+for _filters in product((False, True), repeat=4):
+    HANDLERS[queries.select_identifiers(*_filters)] = _bound(
+        Connection._select, *_filters)
+for _policy, _query in queries.IMPORT_IDENTIFIERS.items():
+    HANDLERS[_query] = _bound(Connection._import, _policy)
+
+
+def _copy_field(value: t.Any) -> str:
+    """Format a field in the COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        return "\\\\x" + value.hex()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r"))
+
+
+class Pool:
+    """Pool of in-memory connections, with the interface of asyncpg's."""
+    def __init__(self, max_size: int) -> None:
+        """Create an empty database."""
+        self.store = Store()
+        self._max_size = max_size
+        self._in_use = 0
+        self._semaphore = asyncio.Semaphore(max_size)
+
+    async def acquire(self,
+                      *,
+                      timeout: t.Optional[float] = None) -> Connection:
+        """Get a connection, waiting while max_size are in use."""
+        await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        self._in_use += 1
+        return Connection(self.store)
+
+    async def connect(self) -> Connection:
+        """Open a connection outside the pool."""
+        return Connection(self.store)
+
+    async def release(self, connection: Connection) -> None:
+        """Give a connection back."""
+        self._in_use -= 1
+        self._semaphore.release()
+
+    async def close(self) -> None:
+        """Close the pool."""
+
+    def get_size(self) -> int:
+        """Get the number of open connections."""
+        return self._in_use
+
+    def get_idle_size(self) -> int:
+        """Get the number of idle connections."""
+        return 0
+
+    def get_min_size(self) -> int:
+        """Get the least number of connections."""
+        return 0
+
+    def get_max_size(self) -> int:
+        """Get the most connections."""
+        return self._max_size
@@ -0,0 +1,256 @@
+"""Instrumentation, exposed in the Prometheus text format.
+
+Metrics are kept per process: each worker serves its own.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import typing as t
+from bisect import bisect_left
+from time import perf_counter
+
+from aiohttp import web
+
+# Upper bounds of the buckets, in seconds or bytes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+KDF_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+REGISTRY: t.List["Metric"] = []
+
+
+def _labels(names: t.Tuple[str, ...], values: t.Tuple[str, ...],
+            **extra: str) -> str:
+    """Format the labels of a sample."""
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        name + '="' + value.replace("\\", "\\\\").replace(
+            "\n", "\\n").replace('"', '\\"') + '"'
+        for name, value in pairs) + "}"
+
+
+class Metric:
+    """Named metric, registered for exposition."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: t.Tuple[str, ...] = ()) -> None:
+        """Register the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def samples(self) -> t.Iterator[str]:
+        """Get the sample lines of the metric."""
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        """Format the metric in the text exposition format."""
+        return "".join((
+            f"# HELP {self.name} {self.documentation}\n",
+            f"# TYPE {self.name} {self.kind}\n",
+            *(f"{line}\n" for line in self.samples()),
+        ))
+
+
+class Counter(Metric):
+    """Count of events."""
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the counter."""
+        super().__init__(*args, **kwargs)
+        self.values: t.Dict[t.Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """Count events."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> t.Iterator[str]:
+        """Get the sample lines of the counter."""
+        for labels, value in self.values.items():
+            yield f"{self.name}_total{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    """Distribution of observed values."""
+
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: t.Tuple[float, ...] = LATENCY_BUCKETS,
+                 **kwargs) -> None:
+        """Initialize the histogram."""
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # Per label values: the count of each bucket, then the sum
+        self.values: t.Dict[t.Tuple[str, ...], t.List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Record a value."""
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels: str) -> "Timer":
+        """Record the duration of a block, in seconds."""
+        return Timer(self, labels)
+
+    def snapshot(self, *labels: str) -> t.Dict[str, t.Any]:
+        """Get the cumulative buckets, sum and count of a histogram."""
+        counts = self.values.get(labels, [0] * (len(self.buckets) + 2))
+        buckets = {}
+        total = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            total += count
+            buckets[str(bound)] = total
+        return {"buckets": buckets, "sum": counts[-1], "count": total}
+
+    def samples(self) -> t.Iterator[str]:
+        """Get the sample lines of the histogram."""
+        for labels in self.values:
+            snapshot = self.snapshot(*labels)
+            for bound, count in snapshot["buckets"].items():
+                yield (f"{self.name}_bucket"
+                       f"{_labels(self.labels, labels, le=bound)} {count}")
+            labelled = _labels(self.labels, labels)
+            yield f"{self.name}_sum{labelled} {snapshot['sum']}"
+            yield f"{self.name}_count{labelled} {snapshot['count']}"
+
+
+class Timer:
+    """Context manager recording its duration in a histogram."""
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram,
+                 labels: t.Tuple[str, ...]) -> None:
+        """Initialize the timer."""
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        """Start timing."""
+        self.start = perf_counter()
+
+    def __exit__(self, *_) -> None:
+        """Record the elapsed time."""
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests.",
+    ("method", "route", "status"),
+)
+RESPONSE_BYTES = Histogram(
+    "http_response_size_bytes",
+    "Size of response bodies.",
+    ("route", ),
+    buckets=SIZE_BUCKETS,
+)
+KDF_SECONDS = Histogram(
+    "kdf_duration_seconds",
+    "Time spent deriving password hashes, queueing included.",
+    buckets=KDF_BUCKETS,
+)
+POOL_WAIT_SECONDS = Histogram(
+    "db_pool_acquire_seconds",
+    "Time spent waiting for a database connection.",
+)
+POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts",
+    "Requests which got no database connection in time.",
+)
+QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time spent running database statements.",
+    ("method", ),
+)
+CRYPTO_SECONDS = Histogram(
+    "crypto_duration_seconds",
+    "Time spent encrypting or decrypting sets of identifiers.",
+    ("operation", ),
+)
+JSON_SECONDS = Histogram(
+    "json_encode_seconds",
+    "Time spent encoding JSON responses.",
+)
+AUDIT_EVENTS = Counter(
+    "audit_events",
+    "Events of the audit log, written or dropped.",
+    ("outcome", ),
+)
+
+
+@web.middleware
+async def middleware(
+    request: web.Request,
+    handler: t.Callable[[web.Request], t.Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    """Measure the duration and response size of requests."""
+    start = perf_counter()
+    status = 500
+    size = 0
+    try:
+        response = await handler(request)
+        status = response.status
+        size = (response.body_length
+                if response.prepared else response.content_length or 0)
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        size = len(error.body or b"")
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else ""
+        REQUEST_SECONDS.observe(perf_counter() - start, request.method, route,
+                                str(status))
+        RESPONSE_BYTES.observe(size, route)
+
+
+def _gauge(name: str, documentation: str, value: float) -> str:
+    """Format a gauge read at scrape time."""
+    return (f"# HELP {name} {documentation}\n# TYPE {name} gauge\n"
+            f"{name} {value}\n")
+
+
+async def serve(request: web.Request) -> web.Response:
+    """Expose the metrics to Prometheus."""
+    pool = request.app["asyncpg.pool"].stats()
+    text = "".join((
+        *(metric.expose() for metric in REGISTRY),
+        _gauge("db_pool_connections", "Open database connections.",
+               pool["size"]),
+        _gauge("db_pool_idle_connections", "Idle database connections.",
+               pool["idle"]),
+        _gauge("db_pool_waiting", "Requests waiting for a connection.",
+               pool["waiting"]),
+        _gauge("vault_cache_bytes", "Estimated size of the vault cache.",
+               request.app["vault.cache"].size),
+    ))
+    if request.app.get("audit.log") is not None:
+        text += _gauge("audit_queue_size",
+                       "Audit events waiting to be written.",
+                       request.app["audit.log"].queue.qsize())
+    if "events.hub" in request.app:
+        text += _gauge(
+            "watch_websockets", "Open WebSockets of identifiers/watch.",
+            sum(map(len, request.app["events.hub"].sockets.values())))
+    return web.Response(
+        body=text.encode("utf8"),
+        headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+            "Cache-Control": "no-store",
+        },
+    )
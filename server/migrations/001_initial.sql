@@ -0,0 +1,40 @@
+-- Users, and the identifiers they store.
+-- Written to also adopt databases created before migrations existed.
+
+CREATE TABLE IF NOT EXISTS sessions (
+  id INTEGER GENERATED ALWAYS AS IDENTITY,
+  username VARCHAR(30) NOT NULL,
+  password BYTEA NOT NULL,
+  salt BYTEA NOT NULL,
+  admin BOOLEAN NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS sessions_username ON sessions (username);
+CREATE UNIQUE INDEX IF NOT EXISTS sessions_id ON sessions (id);
+
+CREATE TABLE IF NOT EXISTS identifiers (
+  id INTEGER NOT NULL,
+  context TEXT NOT NULL,
+  username TEXT NOT NULL,
+  password BYTEA NOT NULL,
+  nonce BYTEA NOT NULL
+);
+
+-- Serves every identifier lookup, the sorted reads, and ON CONFLICT
+CREATE UNIQUE INDEX IF NOT EXISTS identifiers_key
+  ON identifiers (id, context, username);
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_constraint WHERE conname = 'identifiers_user'
+  ) THEN
+    ALTER TABLE identifiers ADD CONSTRAINT identifiers_user
+      FOREIGN KEY (id) REFERENCES sessions (id) ON DELETE CASCADE;
+  END IF;
+END
+$$;
+
+-- Leave room on each page for password updates to stay heap-only
+ALTER TABLE sessions SET (fillfactor = 90);
+ALTER TABLE identifiers SET (fillfactor = 85);
@@ -0,0 +1,10 @@
+-- Persistent server-side sessions, identified by the hash of their id.
+
+CREATE TABLE IF NOT EXISTS session_store (
+  key BYTEA PRIMARY KEY,
+  user_id INTEGER,
+  data BYTEA NOT NULL,
+  expires BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS session_store_user_id ON session_store (user_id);
@@ -0,0 +1,14 @@
+-- Prefix and fuzzy search over contexts and usernames.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- Byte-wise ordering, for the prefix ranges of identifiers/search
+CREATE INDEX IF NOT EXISTS identifiers_context_prefix
+  ON identifiers (id, lower(context) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS identifiers_username_prefix
+  ON identifiers (id, lower(username) text_pattern_ops);
+
+-- Trigrams of a user's contexts and usernames, for the similarity operator
+CREATE INDEX IF NOT EXISTS identifiers_trigrams
+  ON identifiers USING gin (id, context gin_trgm_ops, username gin_trgm_ops);
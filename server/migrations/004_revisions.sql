@@ -0,0 +1,59 @@
+-- Revisions of identifiers, and tombstones of the removed ones, so that
+-- clients can fetch only what changed since their last sync.
+
+CREATE SEQUENCE IF NOT EXISTS identifier_revision AS BIGINT;
+
+ALTER TABLE identifiers ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL
+  DEFAULT nextval('identifier_revision');
+CREATE INDEX IF NOT EXISTS identifiers_revision
+  ON identifiers (id, revision);
+
+CREATE TABLE IF NOT EXISTS identifier_tombstones (
+  id INTEGER NOT NULL,
+  context TEXT NOT NULL,
+  username TEXT NOT NULL,
+  revision BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS identifier_tombstones_key
+  ON identifier_tombstones (id, context, username);
+CREATE INDEX IF NOT EXISTS identifier_tombstones_revision
+  ON identifier_tombstones (id, revision);
+
+-- Locking the user row makes the writers of a user commit in the order of
+-- their revisions, so that a client never skips a revision committed late.
+-- Re-encryption sets manager.keep_revision, as the plaintext is unchanged.
+CREATE OR REPLACE FUNCTION identifiers_revise() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE'
+      AND current_setting('manager.keep_revision', true) = 'on' THEN
+    RETURN NEW;
+  END IF;
+  PERFORM 1 FROM sessions WHERE id = NEW.id FOR NO KEY UPDATE;
+  NEW.revision := nextval('identifier_revision');
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION identifiers_tombstone() RETURNS trigger AS $$
+BEGIN
+  PERFORM 1 FROM sessions WHERE id = OLD.id FOR NO KEY UPDATE;
+  -- The user itself is being deleted
+  IF NOT FOUND THEN
+    RETURN OLD;
+  END IF;
+  INSERT INTO identifier_tombstones (id, context, username, revision)
+  VALUES (OLD.id, OLD.context, OLD.username, nextval('identifier_revision'))
+  ON CONFLICT (id, context, username)
+  DO UPDATE SET revision = EXCLUDED.revision;
+  RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS identifiers_revise ON identifiers;
+CREATE TRIGGER identifiers_revise BEFORE INSERT OR UPDATE ON identifiers
+  FOR EACH ROW EXECUTE FUNCTION identifiers_revise();
+
+DROP TRIGGER IF EXISTS identifiers_tombstone ON identifiers;
+CREATE TRIGGER identifiers_tombstone AFTER DELETE ON identifiers
+  FOR EACH ROW EXECUTE FUNCTION identifiers_tombstone();
@@ -0,0 +1,13 @@
+-- Key derivation function and parameters of each password hash, so that
+-- they can change without invalidating the existing hashes.
+
+-- Hashes made so far used PBKDF2-SHA256 with 1,000,000 iterations, unless
+-- HASH_ITERATIONS was changed: then update kdf_params to its value.
+ALTER TABLE sessions
+  ADD COLUMN IF NOT EXISTS kdf TEXT NOT NULL DEFAULT 'pbkdf2_sha256',
+  ADD COLUMN IF NOT EXISTS kdf_params INTEGER[] NOT NULL DEFAULT '{1000000}';
+
+-- New hashes always state how they were made
+ALTER TABLE sessions
+  ALTER COLUMN kdf DROP DEFAULT,
+  ALTER COLUMN kdf_params DROP DEFAULT;
@@ -0,0 +1,22 @@
+-- Publish the writes to identifiers on the manager_events channel, for
+-- the server processes to notify the clients watching. The payload is the
+-- user id and the kind of event. Identical notifications of a transaction
+-- are delivered once at commit, so a batch or an import publishes a single
+-- event (deduplicated in constant time since PostgreSQL 13).
+CREATE OR REPLACE FUNCTION identifiers_notify() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('manager_events', OLD.id || ':changed');
+  -- Re-encryption doesn't change the plaintext, its event is password
+  ELSIF TG_OP = 'INSERT'
+      OR current_setting('manager.keep_revision', true) IS DISTINCT FROM 'on'
+  THEN
+    PERFORM pg_notify('manager_events', NEW.id || ':changed');
+  END IF;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS identifiers_notify ON identifiers;
+CREATE TRIGGER identifiers_notify AFTER INSERT OR UPDATE OR DELETE
+  ON identifiers FOR EACH ROW EXECUTE FUNCTION identifiers_notify();
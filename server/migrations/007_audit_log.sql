@@ -0,0 +1,12 @@
+-- Audit log of authentication and vault events, appended in batches.
+-- Kept when users are deleted.
+
+CREATE TABLE IF NOT EXISTS audit_log (
+  time TIMESTAMPTZ NOT NULL,
+  event TEXT NOT NULL,
+  user_id INTEGER,
+  remote TEXT,
+  detail JSONB
+);
+
+CREATE INDEX IF NOT EXISTS audit_log_user_id ON audit_log (user_id, time);
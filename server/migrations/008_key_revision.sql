@@ -0,0 +1,6 @@
+-- Revision of each user's vault key. A password change re-encrypts the
+-- identifiers while keeping their revisions, so the version of the vault
+-- also covers this one, for caches to drop the ciphertext of the old key.
+
+ALTER TABLE sessions
+  ADD COLUMN IF NOT EXISTS key_revision BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,303 @@
+"""SQL statements.
+
+All the statements issued by the server live here. The registered ones are
+prepared once on each pooled connection, when it is opened.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import typing as t
+from functools import lru_cache
+from itertools import product
+
+import asyncpg
+
+from . import metrics
+
+STATEMENTS: t.List[str] = []
+
+
+def statement(query: str) -> str:
+    """Register a statement to prepare on each connection."""
+    if query not in STATEMENTS:
+        STATEMENTS.append(query)
+    return query
+
+
+class Connection(asyncpg.Connection):
+    """Connection running the registered statements from their preparation."""
+
+    __slots__ = ("_prepared", )
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the connection."""
+        super().__init__(*args, **kwargs)
+        self._prepared: t.Dict[str, t.Any] = {}
+
+    async def prepare_statements(self) -> None:
+        """Prepare the registered statements."""
+        for query in STATEMENTS:
+            self._prepared[query] = await self.prepare(query)
+
+    async def fetch(self, query: str, *args, timeout=None, **kwargs):
+        """Run a query and return the results as a list."""
+        prepared = self._prepared.get(query)
+        with metrics.QUERY_SECONDS.time("fetch"):
+            if prepared is None or kwargs:
+                return await super().fetch(query,
+                                           *args,
+                                           timeout=timeout,
+                                           **kwargs)
+            return await prepared.fetch(*args, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args, timeout=None, **kwargs):
+        """Run a query and return the first row."""
+        prepared = self._prepared.get(query)
+        with metrics.QUERY_SECONDS.time("fetchrow"):
+            if prepared is None or kwargs:
+                return await super().fetchrow(query,
+                                              *args,
+                                              timeout=timeout,
+                                              **kwargs)
+            return await prepared.fetchrow(*args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args, column=0, timeout=None):
+        """Run a query and return a value in the first row."""
+        prepared = self._prepared.get(query)
+        with metrics.QUERY_SECONDS.time("fetchval"):
+            if prepared is None:
+                return await super().fetchval(query,
+                                              *args,
+                                              column=column,
+                                              timeout=timeout)
+            return await prepared.fetchval(*args,
+                                           column=column,
+                                           timeout=timeout)
+
+    async def execute(self, query: str, *args, timeout=None) -> str:
+        """Run statements and return the status of the last one."""
+        with metrics.QUERY_SECONDS.time("execute"):
+            return await super().execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command: str, args, *, timeout=None) -> None:
+        """Run a statement for each set of arguments."""
+        with metrics.QUERY_SECONDS.time("executemany"):
+            await super().executemany(command, args, timeout=timeout)
+
+
+async def init(connection: Connection) -> None:
+    """Set a new pooled connection up."""
+    await connection.prepare_statements()
+
+
+# Users
+
+GET_USER = statement(
+    "SELECT id, password, salt, kdf, kdf_params, admin FROM sessions "
+    "WHERE username=$1")
+CREATE_USER = statement(
+    "INSERT INTO sessions (username, password, salt, kdf, kdf_params, admin) "
+    "VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (username) DO NOTHING "
+    "RETURNING id")
+# The vault key changes with the password, moving the vault version
+CHANGE_PASSWORD = ("UPDATE sessions SET password=$2, salt=$3, kdf=$4, "
+                   "kdf_params=$5, "
+                   "key_revision=nextval('identifier_revision') WHERE id=$1")
+# Unless the password changed since it was checked
+REHASH_PASSWORD = statement(
+    "UPDATE sessions SET password=$3, salt=$4, kdf=$5, kdf_params=$6 "
+    "WHERE id=$1 AND password=$2")
+
+# Identifiers
+
+IDENTIFIER_COLUMNS = ("context", "username", "password", "nonce")
+
+
+@lru_cache(maxsize=None)
+def select_identifiers(
+    context: bool = False,
+    username: bool = False,
+    after: bool = False,
+    limit: bool = False,
+    columns: t.Tuple[str, ...] = IDENTIFIER_COLUMNS,
+) -> str:
+    """Build the query selecting a user's identifiers, sorted.
+
+    The user id is always the first argument, then come in order the
+    arguments of the filters enabled: the context, the username, the
+    context and username after which to start, and the row limit.
+    """
+    conditions = ["id=$1"]
+    count = 1
+    for name, enabled in (("context", context), ("username", username)):
+        if enabled:
+            count += 1
+            conditions.append(f"{name}=${count}")
+    if after:
+        count += 2
+        conditions.append(f"(context, username) > (${count - 1}, ${count})")
+    query = (f"SELECT {', '.join(columns)} FROM identifiers "
+             f"WHERE {' AND '.join(conditions)} ORDER BY context, username")
+    if limit:
+        query += f" LIMIT ${count + 1}"
+    return query
+
+
+for _filters in product((False, True), repeat=4):
+    statement(select_identifiers(*_filters))
+
+INSERT_IDENTIFIER = statement(
+    "INSERT INTO identifiers (id, context, username, password, nonce) "
+    "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (id, context, username) "
+    "DO NOTHING RETURNING 1")
+UPDATE_IDENTIFIER = statement("UPDATE identifiers SET password=$4, nonce=$5 "
+                              "WHERE id=$1 AND context=$2 AND username=$3 "
+                              "RETURNING 1")
+UPSERT_IDENTIFIER = (
+    "INSERT INTO identifiers (id, context, username, password, nonce) "
+    "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (id, context, username) "
+    "DO UPDATE SET password=EXCLUDED.password, nonce=EXCLUDED.nonce")
+REMOVE_IDENTIFIER = statement("DELETE FROM identifiers "
+                              "WHERE id=$1 AND context=$2 AND username=$3 "
+                              "RETURNING 1")
+
+# Changes after a revision, taking the user id, the revision and the row
+# limit. Removed identifiers come with a null password and nonce. Not
+# prepared upfront, as the tables come from a migration.
+
+SELECT_CHANGES = (
+    "SELECT context, username, password, nonce, revision FROM identifiers "
+    "WHERE id=$1 AND revision > $2 UNION ALL "
+    "SELECT context, username, NULL, NULL, revision "
+    "FROM identifier_tombstones WHERE id=$1 AND revision > $2 "
+    "ORDER BY revision LIMIT $3")
+
+# Version of a user's identifiers, growing with every write and password
+# change. Not prepared upfront either.
+
+VAULT_VERSION = (
+    "SELECT coalesce(greatest((SELECT max(revision) FROM identifiers "
+    "WHERE id=$1), (SELECT max(revision) FROM identifier_tombstones "
+    "WHERE id=$1), (SELECT key_revision FROM sessions WHERE id=$1)), 0)")
+
+# Search, taking the user id, the lowercased query, the upper bound of the
+# text it starts, and the row limit
+
+_PREFIXED = ("(lower(context) ~>=~ $2 AND lower(context) ~<~ $3 "
+             "OR lower(username) ~>=~ $2 AND lower(username) ~<~ $3)")
+SEARCH_PREFIX = statement(
+    "SELECT context, username, password, nonce, 1::real AS score "
+    f"FROM identifiers WHERE id=$1 AND {_PREFIXED} "
+    "ORDER BY context, username LIMIT $4")
+# Not prepared upfront, as it relies on the pg_trgm extension. The %
+# operator matches above pg_trgm.similarity_threshold, the pool setting it
+# to SEARCH_SIMILARITY.
+SEARCH_FUZZY = (
+    "SELECT context, username, password, nonce, "
+    f"CASE WHEN {_PREFIXED} THEN 1::real "
+    "ELSE greatest(similarity(context, $2), similarity(username, $2)) "
+    "END AS score FROM identifiers "
+    f"WHERE id=$1 AND ({_PREFIXED} OR context % $2 OR username % $2) "
+    "ORDER BY score DESC, context, username LIMIT $4")
+
+# Re-encryption on password change
+
+CREATE_REKEY_TABLE = ("CREATE TEMPORARY TABLE rekey (context TEXT, "
+                      "username TEXT, password BYTEA) ON COMMIT DROP")
+APPLY_REKEY = (
+    "UPDATE identifiers SET password=rekey.password FROM rekey "
+    "WHERE identifiers.id=$1 AND identifiers.context=rekey.context "
+    "AND identifiers.username=rekey.username")
+# Re-encrypted identifiers keep their revision, as their plaintext is the same
+KEEP_REVISIONS = "SET LOCAL manager.keep_revision = on"
+
+# Bulk import
+
+CREATE_IMPORT_TABLE = (
+    "CREATE TEMPORARY TABLE import (position BIGINT, context TEXT, "
+    "username TEXT, password BYTEA, nonce BYTEA) ON COMMIT DROP")
+IMPORT_COLUMNS = ("position", "context", "username", "password", "nonce")
+IMPORT_IDENTIFIERS = {
+    "fail":
+    ("WITH inserted AS (INSERT INTO identifiers "
+     "(id, context, username, password, nonce) "
+     "SELECT $1::integer, context, username, password, nonce FROM import "
+     "RETURNING 1) SELECT count(*) FROM inserted"),
+    "skip":
+    ("WITH inserted AS (INSERT INTO identifiers "
+     "(id, context, username, password, nonce) "
+     "SELECT $1::integer, context, username, password, nonce FROM import "
+     "ORDER BY position ON CONFLICT (id, context, username) DO NOTHING "
+     "RETURNING 1) SELECT count(*) FROM inserted"),
+    "overwrite":
+    ("WITH inserted AS (INSERT INTO identifiers "
+     "(id, context, username, password, nonce) "
+     "SELECT DISTINCT ON (context, username) "
+     "$1::integer, context, username, password, nonce FROM import "
+     "ORDER BY context, username, position DESC "
+     "ON CONFLICT (id, context, username) DO UPDATE "
+     "SET password=EXCLUDED.password, nonce=EXCLUDED.nonce "
+     "RETURNING 1) SELECT count(*) FROM inserted"),
+}
+
+# Batched mutations, taking the user id then one array per column
+
+BATCH_INSERT = statement(
+    "INSERT INTO identifiers (id, context, username, password, nonce) "
+    "SELECT $1::integer, * FROM unnest($2::text[], $3::text[], "
+    "$4::bytea[], $5::bytea[]) ON CONFLICT (id, context, username) "
+    "DO NOTHING RETURNING context, username")
+BATCH_UPDATE = statement(
+    "UPDATE identifiers SET password=batch.password, nonce=batch.nonce "
+    "FROM unnest($2::text[], $3::text[], $4::bytea[], $5::bytea[]) "
+    "AS batch (context, username, password, nonce) "
+    "WHERE identifiers.id=$1 AND identifiers.context=batch.context "
+    "AND identifiers.username=batch.username "
+    "RETURNING identifiers.context, identifiers.username")
+BATCH_REMOVE = statement(
+    "DELETE FROM identifiers WHERE id=$1 AND (context, username) IN "
+    "(SELECT * FROM unnest($2::text[], $3::text[])) "
+    "RETURNING context, username")
+
+# Persistent sessions, identified by the hash of their id
+
+LOAD_SESSION = ("SELECT data FROM session_store WHERE key=$1 "
+                "AND expires > extract(epoch FROM now())")
+SAVE_SESSION = (
+    "INSERT INTO session_store (key, user_id, data, expires) "
+    "VALUES ($1, $2, $3, $4) ON CONFLICT (key) DO UPDATE "
+    "SET user_id=EXCLUDED.user_id, data=EXCLUDED.data, "
+    "expires=EXCLUDED.expires")
+REVOKE_SESSION = "DELETE FROM session_store WHERE key=$1"
+REVOKE_USER_SESSIONS = ("DELETE FROM session_store "
+                        "WHERE user_id=$1 AND key IS DISTINCT FROM $2")
+PURGE_SESSIONS = ("DELETE FROM session_store "
+                  "WHERE expires <= extract(epoch FROM now())")
+
+# Change events, with a payload of "<user id>:<kind>", delivered on commit.
+# The writes to identifiers publish theirs from a trigger.
+
+EVENTS_CHANNEL = "manager_events"
+PUBLISH = statement("SELECT pg_notify($1, $2)")
+# Sessions written or revoked, for the other processes to drop them from
+# their cache: the hex digest of a session id, or "user:<user id>:<digest>"
+# for all the sessions of a user but one, whose digest may be empty.
+SESSIONS_CHANNEL = "manager_sessions"
+
+# Schema management
+
+CREATE_SCHEMA_VERSION = (
+    "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, "
+    "applied TIMESTAMPTZ NOT NULL DEFAULT now())")
+LOCK_SCHEMA = "SELECT pg_advisory_xact_lock(hashtext('schema_version'))"
+SCHEMA_VERSION = "SELECT coalesce(max(version), 0) FROM schema_version"
+SET_SCHEMA_VERSION = "INSERT INTO schema_version (version) VALUES ($1)"
+LIST_INDEXES = (
+    "SELECT tab.relname AS table_name, ind.indisunique AS is_unique, "
+    "array_agg(att.attname ORDER BY k.position) AS columns "
+    "FROM pg_index ind JOIN pg_class tab ON tab.oid = ind.indrelid "
+    "JOIN LATERAL unnest(ind.indkey) WITH ORDINALITY AS k (num, position) "
+    "ON true JOIN pg_attribute att "
+    "ON att.attrelid = tab.oid AND att.attnum = k.num "
+    "WHERE tab.relname = ANY($1::text[]) AND pg_table_is_visible(tab.oid) "
+    "GROUP BY ind.indexrelid, tab.relname, ind.indisunique")
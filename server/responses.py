@@ -0,0 +1,139 @@
+"""Encoding of responses.
+
+JSON is encoded with orjson when it is installed, and the standard library
+otherwise. Bodies of at least COMPRESSION_MIN_SIZE bytes are compressed
+when the client accepts gzip or deflate.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import gzip
+import json
+import typing as t
+import zlib
+
+from aiohttp import hdrs, web
+from aiohttp.web_response import ContentCoding
+
+from . import config, metrics
+
+try:
+    from orjson import dumps
+except ImportError:
+
+    def dumps(data: t.Any) -> bytes:
+        """Encode data as JSON."""
+        return json.dumps(data, separators=(",", ":")).encode("utf8")
+
+
+# In order of preference, at equal quality values
+CODINGS = (ContentCoding.gzip, ContentCoding.deflate)
+# Compression of constant bodies, as aiohttp does on the fly
+ENCODERS = {
+    ContentCoding.gzip: lambda body: gzip.compress(body, mtime=0),
+    ContentCoding.deflate: zlib.compress,
+}
+
+
+def negotiate(request: web.Request) -> t.Optional[ContentCoding]:
+    """Pick the compression preferred by the client, if any."""
+    weights: t.Dict[str, float] = {}
+    for item in request.headers.get(hdrs.ACCEPT_ENCODING, "").split(","):
+        coding, *params = item.split(";")
+        weight = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+    default = weights.get("*", 0.0)
+    best = max(CODINGS, key=lambda coding: weights.get(coding.value, default))
+    return best if weights.get(best.value, default) > 0 else None
+
+
+def compress(request: web.Request,
+             response: web.StreamResponse,
+             size: t.Optional[int] = None) -> None:
+    """Compress a response if it is large enough, its size unknown if None.
+
+    Call before the response is prepared.
+    """
+    if config.COMPRESSION_MIN_SIZE is None or (
+            size is not None and size < config.COMPRESSION_MIN_SIZE):
+        return
+    response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+    coding = negotiate(request)
+    if coding is not None:
+        response.enable_compression(coding)
+
+
+def precompress(
+        body: bytes) -> t.Dict[t.Optional[ContentCoding], bytes]:
+    """Compress a constant body once in each coding, if large enough.
+
+    The identity is under None.
+    """
+    variants: t.Dict[t.Optional[ContentCoding], bytes] = {None: body}
+    if (config.COMPRESSION_MIN_SIZE is not None
+            and len(body) >= config.COMPRESSION_MIN_SIZE):
+        for coding, encode in ENCODERS.items():
+            variants[coding] = encode(body)
+    return variants
+
+
+def json_response(request: web.Request, data: t.Any,
+                  **kwargs: t.Any) -> web.Response:
+    """Build a JSON response, timing the encoding."""
+    with metrics.JSON_SECONDS.time():
+        body = dumps(data)
+    response = web.Response(body=body,
+                            content_type="application/json",
+                            **kwargs)
+    compress(request, response, len(body))
+    return response
+
+
+class Failure:
+    """Error of a constant message, whose body is encoded once."""
+
+    __slots__ = ("exception", "reason", "body", "headers")
+
+    def __init__(
+        self,
+        exception: t.Type[web.HTTPException],
+        msg: str,
+        error_code: str,
+        headers: t.Optional[t.Dict[str, str]] = None,
+        **fields: t.Any,
+    ) -> None:
+        """Encode the body of the error."""
+        self.exception = exception
+        self.reason = msg
+        self.body = dumps({
+            "success": False,
+            "msg": msg,
+            "error_code": error_code,
+            **fields,
+        })
+        self.headers = headers
+
+    def __call__(
+        self,
+        headers: t.Optional[t.Dict[str, str]] = None,
+    ) -> web.HTTPException:
+        """Build the error to raise, with its own headers if given."""
+        return self.exception(
+            reason=self.reason,
+            headers=self.headers if headers is None else headers,
+            body=self.body,
+            content_type="application/json",
+        )
+
+
+def failure(exception: t.Type[web.HTTPException], msg: str, error_code: str,
+            **kwargs: t.Any) -> web.HTTPException:
+    """Build an error of a variable message, to raise."""
+    return Failure(exception, msg, error_code, **kwargs)()
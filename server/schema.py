@@ -0,0 +1,80 @@
+"""Database schema management.
+
+Migrations are the SQL files of the migrations directory, applied in the
+order of the version number prefixing their name.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import logging
+import typing as t
+from pathlib import Path
+
+import asyncpg
+
+from . import queries
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = Path(__file__).parent / "migrations"
+
+# Indexes the hot queries rely on: table, leading columns, and uniqueness
+EXPECTED_INDEXES = (
+    ("sessions", ("username", ), True),
+    ("sessions", ("id", ), True),
+    ("identifiers", ("id", "context", "username"), True),
+    ("identifiers", ("id", "revision"), False),
+    ("identifier_tombstones", ("id", "context", "username"), True),
+    ("identifier_tombstones", ("id", "revision"), False),
+    ("session_store", ("key", ), True),
+    ("session_store", ("user_id", ), False),
+    ("audit_log", ("user_id", ), False),
+)
+
+
+def migrations() -> t.List[t.Tuple[int, str, str]]:
+    """List the version, name and SQL of the migrations, in order."""
+    return sorted((int(path.name.split("_", 1)[0]), path.stem,
+                   path.read_text("utf8"))
+                  for path in MIGRATIONS.glob("*.sql"))
+
+
+async def migrate(database: asyncpg.Connection) -> int:
+    """Apply the pending migrations, returning how many were applied."""
+    applied = 0
+    async with database.transaction():
+        # Serialize processes migrating the same database, which would
+        # otherwise conflict creating the table
+        await database.execute(queries.LOCK_SCHEMA)
+        await database.execute(queries.CREATE_SCHEMA_VERSION)
+    for version, name, sql in migrations():
+        async with database.transaction():
+            # Serialize processes migrating the same database
+            await database.execute(queries.LOCK_SCHEMA)
+            if await database.fetchval(queries.SCHEMA_VERSION) >= version:
+                continue
+            logger.info("Applying migration %s", name)
+            await database.execute(sql)
+            await database.execute(queries.SET_SCHEMA_VERSION, version)
+            applied += 1
+    return applied
+
+
+async def check(database: asyncpg.Connection) -> t.List[str]:
+    """Get a description of the expected indexes which are missing."""
+    indexes = await database.fetch(
+        queries.LIST_INDEXES,
+        list({table
+              for table, *_ in EXPECTED_INDEXES}),
+    )
+    missing = []
+    for table, columns, unique in EXPECTED_INDEXES:
+        if not any(
+                index["table_name"] == table
+                and tuple(index["columns"][:len(columns)]) == columns and (
+                    not unique or index["is_unique"]
+                    and len(index["columns"]) == len(columns))
+                for index in indexes):
+            missing.append(f"{'unique ' * unique}index on "
+                           f"{table} ({', '.join(columns)})")
+    return missing
@@ -0,0 +1,82 @@
+"""In-process search over cached identifiers.
+
+Mirrors the queries of identifiers/search: case-insensitive prefix matches
+on the context or username, then trigram similarity as computed by
+Postgres' pg_trgm.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import re
+import typing as t
+from bisect import bisect_left
+from heapq import nsmallest
+
+from . import config
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(text: str) -> t.FrozenSet[str]:
+    """Get the trigrams of a text, the way pg_trgm does."""
+    result = set()
+    for word in WORD.findall(text.lower()):
+        word = f"  {word} "
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return frozenset(result)
+
+
+def similarity(first: t.FrozenSet[str], second: t.FrozenSet[str]) -> float:
+    """Get the similarity of two sets of trigrams, between 0 and 1."""
+    if not first or not second:
+        return 0.0
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+
+class SearchIndex:
+    """Index of a user's cached identifiers, sorted by context and username.
+
+    The lowercased contexts and usernames are kept sorted, so that the ones
+    starting with a prefix form a contiguous range.
+    """
+    def __init__(self, rows: t.List[t.Any]) -> None:
+        """Build the index."""
+        self.rows = rows
+        self.keys = sorted((text.lower(), position)
+                           for position, row in enumerate(rows)
+                           for text in (row["context"], row["username"]))
+        self.trigrams = [(trigrams(row["context"]), trigrams(row["username"]))
+                         for row in rows]
+
+    def prefixed(self, prefix: str) -> t.Set[int]:
+        """Get the positions of the rows with a field starting with prefix."""
+        prefix = prefix.lower()
+        found = set()
+        for index in range(bisect_left(self.keys, (prefix, )),
+                           len(self.keys)):
+            text, position = self.keys[index]
+            if not text.startswith(prefix):
+                break
+            found.add(position)
+        return found
+
+    def search(
+        self,
+        query: str,
+        fuzzy: bool,
+        limit: int,
+    ) -> t.List[t.Tuple[t.Any, float]]:
+        """Get the best matches of a query, with their score."""
+        prefixed = self.prefixed(query)
+        ranked = [(-1.0, position) for position in prefixed]
+        if fuzzy:
+            searched = trigrams(query)
+            for position, fields in enumerate(self.trigrams):
+                if position in prefixed:
+                    continue
+                score = max(similarity(searched, field) for field in fields)
+                if score >= config.SEARCH_SIMILARITY:
+                    ranked.append((-score, position))
+        return [(self.rows[position], -score)
+                for score, position in nsmallest(limit, ranked)]
@@ -3,111 +3,171 @@
 Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
-import json
-from hashlib import pbkdf2_hmac, sha256
+import logging
+from hashlib import sha256
+from hmac import compare_digest
 from os import urandom
 
+import asyncpg
 from aiohttp import web
 from aiohttp_session import get_session, new_session
-from Cryptodome.Cipher import AES
 
-from . import config
-from .utils import authenticated, optional, required
+from . import audit, config, crypto, events, kdf, queries
+from .responses import Failure, failure, json_response
+from .storage import ServerStorage
+from .utils import (ADMIN_REQUIRED, authenticated, get_json, optional,
+                    rate_limited, required)
 
+logger = logging.getLogger(__name__)
 
+WRONG_PASSWORD = Failure(web.HTTPForbidden, "Wrong password", "wrong_password")
+
+
+@rate_limited
 @required(username=str, password=str)
 async def login(request: web.Request) -> web.Response:
     """Implement login functionality.
 
+    A password hashed with other than the configured key derivation is
+    hashed again once verified.
+
     Required parameters:
     - username: string
     - password: string
     """
-    data = await request.json()
+    data = await get_json(request)
 
-    session = await new_session(request)
-    session["remote"] = request.remote
     async with request.app["asyncpg.pool"].acquire() as database:
-        row = await database.fetchrow(
-            "SELECT * FROM sessions WHERE username=$1", data["username"])
+        row = await database.fetchrow(queries.GET_USER, data["username"])
 
     if not row:
-        raise web.HTTPForbidden(
-            reason=f"User {data['username']} does not exist",
-            text=json.dumps(
-                {
-                    "success": False,
-                    "msg": f"User {data['username']} does not exist",
-                    "error_code": "unknown_user",
-                }, ),
-        )
-
-    pass_bytes = bytes(request["password"], "utf8")
-
-    if (pbkdf2_hmac("sha256", pass_bytes, row["salt"], config.HASH_ITERATIONS)
-            != row["password"]):
-        raise web.HTTPForbidden(
-            reason="Wrong password",
-            text=json.dumps({
-                "success": False,
-                "msg": "Wrong password",
-                "error_code": "wrong_password",
-            }),
-        )
+        await audit.record(request,
+                           "login_failed",
+                           username=data["username"],
+                           reason="unknown_user")
+        raise failure(web.HTTPForbidden,
+                      f"User {data['username']} does not exist",
+                      "unknown_user")
+
+    if not compare_digest(
+            await kdf.derive(request.app, data["password"], row["salt"],
+                             row["kdf"], row["kdf_params"]),
+            row["password"],
+    ):
+        await audit.record(request,
+                           "login_failed",
+                           row["id"],
+                           username=data["username"],
+                           reason="wrong_password")
+        raise WRONG_PASSWORD()
+    if kdf.outdated(row["kdf"], row["kdf_params"]):
+        await rehash(request.app, row, data["password"])
+    # Only now, so that failed attempts do not store sessions
+    session = await new_session(request)
+    session["remote"] = request.remote
     session["id"] = row["id"]
     session["admin"] = row["admin"]
 
-    session["password"] = sha256(pass_bytes).digest()
+    session["password"] = sha256(bytes(data["password"], "utf8")).digest()
+
+    await audit.record(request, "login", row["id"])
+    return json_response(request, {"success": True})
+
+
+async def rehash(app: web.Application, row: asyncpg.Record,
+                 password: str) -> None:
+    """Hash a verified password again, with the configured KDF."""
+    salt = urandom(config.SALT_LENGTH)
+    hashed = await kdf.derive(app, password, salt)
+    async with app["asyncpg.pool"].acquire() as database:
+        await database.execute(
+            queries.REHASH_PASSWORD,
+            row["id"],
+            row["password"],
+            hashed,
+            salt,
+            config.KDF_ALGORITHM,
+            list(config.KDF_PARAMETERS),
+        )
+    logger.info("User %s: password rehashed with %s %s", row["id"],
+                config.KDF_ALGORITHM, config.KDF_PARAMETERS)
+
 
-    return web.json_response({"success": True})
+@authenticated
+async def logout(request: web.Request) -> web.Response:
+    """Close the current session."""
+    session = await get_session(request)
+    session.invalidate()
+    return json_response(request, {"success": True})
 
 
+@rate_limited
 @authenticated
 @required(password=str)
 async def password(request: web.Request) -> web.Response:
     """Change your password.
 
+    All the stored identifiers are re-encrypted in a single transaction.
+    The response holds the number of re-encrypted identifiers. The other
+    sessions of the user are closed, when the session storage allows it,
+    and the watching clients are told to log in again.
+
     Required parameters:
     - password: string
     """
-    data = await request.json()
+    data = await get_json(request)
 
     session = await get_session(request)
 
     salt = urandom(config.SALT_LENGTH)
+    hashed = await kdf.derive(request.app, data["password"], salt)
+    new_pass = sha256(bytes(data["password"], "utf8")).digest()
+    count = 0
     async with request.app["asyncpg.pool"].acquire() as database:
-        await database.execute(
-            "UPDATE sessions SET password=$2 AND salt=$3 WHERE id=$1",
-            session["id"],
-            salt,
-            pbkdf2_hmac("sha256", bytes(data["password"], "utf8"), salt,
-                        config.HASH_ITERATIONS),
-        )
-        new_pass = sha256(bytes(data["password"], "utf8")).digest()
-        for row in await database.fetch(
-                "SELECT * FROM identifiers WHERE id=$1",
-                session["id"],
-        ):
+        async with database.transaction():
             await database.execute(
-                "UPDATE identifiers SET password=$1 WHERE id=$2 AND context=$3 AND username=$4",
-                AES.new(
-                    new_pass,
-                    AES.MODE_EAX,
-                    nonce=row["nonce"],
-                ).encrypt(
-                    AES.new(
-                        session["password"],
-                        AES.MODE_EAX,
-                        nonce=row["nonce"],
-                    ).decrypt(row["password"])),
-                row["id"],
-                row["context"],
-                row["username"],
+                queries.CHANGE_PASSWORD,
+                session["id"],
+                hashed,
+                salt,
+                config.KDF_ALGORITHM,
+                list(config.KDF_PARAMETERS),
             )
-        session["password"] = new_pass
-    return web.json_response({"success": True})
-
-
+            # Re-encrypted rows are staged in bulk, then applied at once
+            await database.execute(queries.CREATE_REKEY_TABLE)
+            cursor = await database.cursor(
+                queries.select_identifiers(),
+                session["id"],
+            )
+            while rows := await cursor.fetch(config.REKEY_CHUNK_SIZE):
+                await database.copy_records_to_table(
+                    "rekey",
+                    records=await crypto.rekey(
+                        request.app,
+                        session["password"],
+                        new_pass,
+                        rows,
+                    ),
+                )
+                count += len(rows)
+                logger.debug("User %s: %d identifiers re-encrypted",
+                             session["id"], count)
+            await database.execute(queries.KEEP_REVISIONS)
+            await database.execute(queries.APPLY_REKEY, session["id"])
+            await events.publish(database, session["id"], "password")
+    session["password"] = new_pass
+    request.app["vault.cache"].invalidate(session["id"])
+    # Other sessions still hold the previous vault key
+    storage = request.app["session.storage"]
+    if isinstance(storage, ServerStorage):
+        await storage.revoke_user(request.app,
+                                  session["id"],
+                                  keep=session.identity)
+    await audit.record(request, "password_changed", session["id"], count=count)
+    return json_response(request, {"success": True, "count": count})
+
+
+@rate_limited
 @authenticated
 @required(username=str, password=str)
 @optional(admin=bool)
@@ -121,43 +181,30 @@ async def create(request: web.Request) -> web.Response:
     Optional parameters:
     - admin: boolean (default: false)
     """
-    data = await request.json()
+    data = await get_json(request)
 
     session = await get_session(request)
     if not session["admin"]:
-        raise web.HTTPForbidden(
-            reason="Admin required",
-            text=json.dumps({
-                "success": False,
-                "msg": "Admin required",
-                "error_code": "admin_required",
-            }),
-        )
+        raise ADMIN_REQUIRED()
     salt = urandom(config.SALT_LENGTH)
-    async with request.app["asynpg.pool"].acquire() as database:
+    hashed = await kdf.derive(request.app, data["password"], salt)
+    async with request.app["asyncpg.pool"].acquire() as database:
         row = await database.fetchrow(
-            "SELECT * FROM sessions WHERE username=$1", data["username"])
-        if row:
-            raise web.HTTPBadRequest(
-                reason=f"User {data['username']} exists",
-                text=json.dumps(
-                    {
-                        "success": False,
-                        "msg": f"User {data['username']} exists",
-                        "error_code": "user_exists",
-                    }, ),
-            )
-        await database.execute(
-            "INSERT INTO sessions (username, password, salt, admin) VALUES "
-            "($1, $2, $3, $4)",
+            queries.CREATE_USER,
             data["username"],
-            pbkdf2_hmac(
-                "sha256",
-                bytes(request["password"], "utf8"),
-                salt,
-                config.HASH_ITERATIONS,
-            ),
+            hashed,
             salt,
+            config.KDF_ALGORITHM,
+            list(config.KDF_PARAMETERS),
             data.get("admin", False),
         )
-    return web.json_response({"success": True})
+    if not row:
+        raise failure(web.HTTPBadRequest, f"User {data['username']} exists",
+                      "user_exists")
+    await audit.record(request,
+                       "user_created",
+                       row["id"],
+                       username=data["username"],
+                       admin=data.get("admin", False),
+                       by=session["id"])
+    return json_response(request, {"success": True})
@@ -0,0 +1,237 @@
+"""Server-side session storage.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import json
+import os
+import secrets
+import typing as t
+from base64 import b64decode, b64encode
+from collections import OrderedDict, defaultdict
+from hashlib import sha256
+from time import time
+
+import asyncpg
+from aiohttp import web
+from aiohttp_session import AbstractStorage, Session
+from cryptography import fernet
+
+from . import config, queries
+
+
+def _default(value: t.Any) -> t.Any:
+    """Serialize the bytes stored in sessions."""
+    if isinstance(value, bytes):
+        return {"__bytes__": b64encode(value).decode("ascii")}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(value: t.Dict[str, t.Any]) -> t.Any:
+    """Deserialize the bytes stored in sessions."""
+    if value.keys() == {"__bytes__"}:
+        return b64decode(value["__bytes__"])
+    return value
+
+
+def encode(data: t.Any) -> str:
+    """Serialize session data."""
+    return json.dumps(data, default=_default)
+
+
+def decode(data: str) -> t.Any:
+    """Deserialize session data."""
+    return json.loads(data, object_hook=_object_hook)
+
+
+def load_secret() -> bytes:
+    """Get the Fernet key of the sessions.
+
+    It comes from the config, or else from the key file, which is created
+    with a new key if it does not exist.
+    """
+    if config.SESSION_SECRET:
+        key = bytes(config.SESSION_SECRET, "ascii")
+    else:
+        try:
+            descriptor = os.open(config.SESSION_KEY_FILE,
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(config.SESSION_KEY_FILE, "rb") as file:
+                key = file.read().strip()
+        else:
+            key = fernet.Fernet.generate_key()
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(key)
+    fernet.Fernet(key)  # Fail early on malformed keys
+    return key
+
+
+class ServerStorage(AbstractStorage):
+    """Keep sessions on the server, the cookie only holding an opaque id.
+
+    Sessions live in an in-memory LRU cache, by digest of their id. When
+    persistent, they are also written, encrypted, to Postgres, so that they
+    survive restarts and can be shared between processes. When shared, the
+    writes and revocations are published for the other processes to drop
+    their cached copy, through forget and forget_user.
+    """
+    def __init__(
+        self,
+        secret_key: bytes,
+        *,
+        cookie_name: str,
+        max_age: int,
+        cache_size: int,
+        persistent: bool = False,
+        shared: bool = False,
+    ) -> None:
+        """Initialize the storage."""
+        super().__init__(
+            cookie_name=cookie_name,
+            max_age=max_age,
+            encoder=encode,
+            decoder=decode,
+        )
+        self.cache_size = cache_size
+        self.persistent = persistent
+        self.shared = shared
+        # Shared sessions are cached only while the changes are received
+        self.caching = not shared
+        self._fernet = fernet.Fernet(secret_key)
+        self._cache: t.OrderedDict[bytes, t.Dict[str, t.Any]] = OrderedDict()
+        self._users: t.DefaultDict[t.Any, t.Set[bytes]] = defaultdict(set)
+
+    def _remember(self, digest: bytes, data: t.Dict[str, t.Any]) -> None:
+        """Put a session in the cache, evicting the least recently used."""
+        self.forget(digest)
+        if not self.caching:
+            return
+        self._cache[digest] = data
+        self._users[data["session"].get("id")].add(digest)
+        while len(self._cache) > self.cache_size:
+            self.forget(next(iter(self._cache)))
+
+    def forget(self, digest: bytes) -> None:
+        """Remove a session from the cache."""
+        data = self._cache.pop(digest, None)
+        if data is not None:
+            user_id = data["session"].get("id")
+            self._users[user_id].discard(digest)
+            if not self._users[user_id]:
+                del self._users[user_id]
+
+    def forget_user(self, user_id: int, keep: t.Optional[bytes]) -> None:
+        """Remove the sessions of a user from the cache, except one."""
+        for digest in list(self._users.get(user_id, ())):
+            if digest != keep:
+                self.forget(digest)
+
+    def set_caching(self, caching: bool) -> None:
+        """Start or stop caching, emptying the cache.
+
+        Shared sessions are cached while the changes of the other processes
+        are received.
+        """
+        self.caching = caching
+        self._cache.clear()
+        self._users.clear()
+
+    async def _publish(self, database: asyncpg.Connection,
+                       payload: str) -> None:
+        """Tell the other processes to drop their copy of sessions."""
+        if self.shared:
+            await database.execute(queries.PUBLISH,
+                                   queries.SESSIONS_CHANNEL, payload)
+
+    async def load_session(self, request: web.Request) -> Session:
+        """Load the session whose id is in the cookie."""
+        key = self.load_cookie(request)
+        data = None
+        if key:
+            digest = sha256(key.encode()).digest()
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+            elif self.persistent:
+                async with request.app["asyncpg.pool"].acquire() as database:
+                    row = await database.fetchrow(queries.LOAD_SESSION,
+                                                  digest)
+                if row:
+                    data = self._decoder(
+                        self._fernet.decrypt(row["data"]).decode("utf8"))
+                    self._remember(digest, data)
+            if data is not None and time() - data["created"] > self.max_age:
+                self.forget(digest)
+                data = None
+        if data is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        return Session(key, data=data, new=False, max_age=self.max_age)
+
+    async def save_session(
+        self,
+        request: web.Request,
+        response: web.StreamResponse,
+        session: Session,
+    ) -> None:
+        """Store a session, giving it an id if it is new.
+
+        Sessions not logged in are dropped rather than stored.
+        """
+        key = session.identity
+        if session.empty or "id" not in session:
+            if key is not None:
+                await self.revoke(request.app, key)
+            self.save_cookie(response, "", max_age=session.max_age)
+            return
+
+        if key is None:
+            key = secrets.token_urlsafe(32)
+            session.set_new_identity(key)
+        digest = sha256(key.encode()).digest()
+        data = {"created": session.created, "session": dict(session)}
+        self._remember(digest, data)
+        if self.persistent:
+            async with request.app["asyncpg.pool"].acquire() as database:
+                await database.execute(
+                    queries.SAVE_SESSION,
+                    digest,
+                    data["session"].get("id"),
+                    self._fernet.encrypt(bytes(self._encoder(data), "utf8")),
+                    data["created"] + self.max_age,
+                )
+                await self._publish(database, digest.hex())
+        self.save_cookie(response, key, max_age=session.max_age)
+
+    async def revoke(self, app: web.Application, key: str) -> None:
+        """Revoke a session."""
+        digest = sha256(key.encode()).digest()
+        self.forget(digest)
+        if self.persistent:
+            async with app["asyncpg.pool"].acquire() as database:
+                await database.execute(queries.REVOKE_SESSION, digest)
+                await self._publish(database, digest.hex())
+
+    async def revoke_user(
+        self,
+        app: web.Application,
+        user_id: int,
+        keep: t.Optional[str] = None,
+    ) -> None:
+        """Revoke all the sessions of a user, except the one to keep."""
+        kept = keep and sha256(keep.encode()).digest()
+        self.forget_user(user_id, kept)
+        if self.persistent:
+            async with app["asyncpg.pool"].acquire() as database:
+                await database.execute(queries.REVOKE_USER_SESSIONS, user_id,
+                                       kept)
+                await self._publish(
+                    database, f"user:{user_id}:{kept.hex() if kept else ''}")
+
+
+async def startup(app: web.Application) -> None:
+    """Purge the expired persistent sessions."""
+    storage = app["session.storage"]
+    if isinstance(storage, ServerStorage) and storage.persistent:
+        async with app["asyncpg.pool"].acquire() as database:
+            await database.execute(queries.PURGE_SESSIONS)
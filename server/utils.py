@@ -4,6 +4,7 @@ Copyright (C) 2021  Faholan <https://github.com/Faholan>
 """
 
 import json
+import re
 import typing as t
 from inspect import getdoc
 
@@ -11,9 +12,31 @@ from aiohttp import web
 from aiohttp_session import get_session
 
 from . import config
+from .responses import Failure
 
 Handler = t.Callable[[web.Request], t.Awaitable[web.StreamResponse]]
 
+COPY_ESCAPES = {
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+}
+COPY_ESCAPE = re.compile(rb"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))",
+                         re.DOTALL)
+
+MALFORMED_JSON = Failure(web.HTTPBadRequest, "Malformed JSON data",
+                         "malformed_json")
+AUTH_REQUIRED = Failure(web.HTTPForbidden, "Authentication required",
+                        "auth_required")
+ADMIN_REQUIRED = Failure(web.HTTPForbidden, "Admin required",
+                         "admin_required")
+# The Retry-After header follows the configured rate
+RATE_LIMITED = Failure(web.HTTPTooManyRequests, "Too many requests",
+                       "rate_limited")
+
 
 def get_subroutes(path: str,
                   app: web.Application) -> t.List[t.Dict[str, t.Any]]:
@@ -53,42 +76,70 @@ def get_required(handler: Handler) -> t.Dict[str, str]:
     }
 
 
+async def get_json(request: web.Request) -> t.Dict[str, t.Any]:
+    """Get the JSON payload of a request, decoding it only once.
+
+    An empty body is treated as an empty payload.
+    """
+    data = request.get("utils.json")
+    if data is not None:
+        return data
+
+    body = await request.read()
+    data = {}
+    if body:
+        try:
+            data = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            data = None
+        if not isinstance(data, dict):
+            raise MALFORMED_JSON()
+    request["utils.json"] = data
+    return data
+
+
+def not_modified(request: web.Request, etag: str) -> bool:
+    """Check whether the client already has the version tagged etag."""
+    return any(tag.value in (etag, "*")
+               for tag in request.if_none_match or ())
+
+
+def compile_validator(
+    fields: t.Dict[str, t.Type],
+    mandatory: bool,
+) -> t.Callable[[t.Dict[str, t.Any]], None]:
+    """Build a function checking a payload against the fields.
+
+    The error messages are prepared once, when the handler is decorated.
+    """
+    checks = tuple((
+        name,
+        datatype,
+        Failure(web.HTTPBadRequest, f"Missing field {name}", "missing_field"),
+        Failure(web.HTTPBadRequest, f"Field {name} must be of type {datatype}",
+                "wrong_field_type"),
+    ) for name, datatype in fields.items())
+
+    def validate(data: t.Dict[str, t.Any]) -> None:
+        """Raise an HTTP error if the payload does not match the fields."""
+        for name, datatype, missing, wrong in checks:
+            if name not in data:
+                if mandatory:
+                    raise missing()
+            elif not isinstance(data[name], datatype):
+                raise wrong()
+
+    return validate
+
+
 def required(**fields: t.Type):
     """Require json data with specific field types."""
     def callback(handler):
         """Handle the function conversion."""
+        validate = compile_validator(fields, True)
+
         async def check_and_run(request: web.Request) -> web.Response:
-            try:
-                data = await request.json()
-            except json.JSONDecodeError:
-                raise web.HTTPBadRequest(
-                    reason="Malformed JSON data",
-                    text=json.dumps({
-                        "success": False,
-                        "msg": "Malformed JSON data",
-                        "error_code": "malformed_json",
-                    }),
-                )
-
-            for name, datatype in fields.items():
-                if name not in data:
-                    raise web.HTTPBadRequest(
-                        reason=f"Missing field {name}",
-                        text=json.dumps({
-                            "success": False,
-                            "msg": f"Missing field {name}",
-                            "error_code": "missing_field",
-                        }),
-                    )
-                if not isinstance(data[name], datatype):
-                    raise web.HTTPBadRequest(
-                        reason=f"Field {name} must be of type {datatype}",
-                        text=json.dumps({
-                            "success": False,
-                            "msg": f"Field {name} must be of type {datatype}",
-                            "error_code": "wrong_field_type",
-                        }),
-                    )
+            validate(await get_json(request))
             return await handler(request)
 
         for key, value in handler.__dict__.items():
@@ -104,31 +155,10 @@ def optional(**fields: t.Type):
     """Check for type of optional fields."""
     def callback(handler):
         """Handle the function conversion."""
+        validate = compile_validator(fields, False)
+
         async def check_and_run(request: web.Request) -> web.Response:
-            if await request.text() == "":
-                return await handler(request)
-            try:
-                data = await request.json()
-            except json.JSONDecodeError:
-                raise web.HTTPBadRequest(
-                    reason="Malformed JSON data",
-                    text=json.dumps({
-                        "success": False,
-                        "msg": "Malformed JSON data",
-                        "error_code": "malformed_json",
-                    }),
-                )
-
-            for name, datatype in fields.items():
-                if name in data and not isinstance(data[name], datatype):
-                    raise web.HTTPBadRequest(
-                        reason=f"Field {name} must be of type {datatype}",
-                        text=json.dumps({
-                            "success": False,
-                            "msg": f"Field {name} must be of type {datatype}",
-                            "error_code": "wrong_field_type",
-                        }),
-                    )
+            validate(await get_json(request))
             return await handler(request)
 
         for key, value in handler.__dict__.items():
@@ -148,15 +178,7 @@ def authenticated(handler):
 
         if (session.get("id", None) is None
                 or session.get("remote", None) != request.remote):
-            raise web.HTTPForbidden(
-                reason="Authentication required",
-                text=json.dumps(
-                    {
-                        "success": False,
-                        "msg": "Authentication required",
-                        "error_code": "auth_required",
-                    }, ),
-            )
+            raise AUTH_REQUIRED()
         return await handler(request)
 
     check_and_run.authenticated = True
@@ -164,3 +186,38 @@ def authenticated(handler):
         setattr(check_and_run, key, value)
     check_and_run.description = get_description(handler)
     return check_and_run
+
+
+def rate_limited(handler):
+    """Limit the rate of requests per remote address."""
+    async def check_and_run(request: web.Request) -> web.Response:
+        """Take a token from the remote's bucket and defer to handler."""
+        if not request.app["admission.rate"].allow(request.remote):
+            raise RATE_LIMITED(headers={
+                "Retry-After":
+                str(max(1, round(1 / config.RATE_LIMIT_RATE))),
+            })
+        return await handler(request)
+
+    for key, value in handler.__dict__.items():
+        setattr(check_and_run, key, value)
+    check_and_run.description = get_description(handler)
+    return check_and_run
+
+
+def _unescape_copy(match: t.Match[bytes]) -> bytes:
+    """Decode a backslash sequence of the COPY text format."""
+    octal, hexadecimal, char = match.groups()
+    if octal:
+        return bytes([int(octal, 8) & 0xFF])
+    if hexadecimal:
+        return bytes([int(hexadecimal, 16)])
+    return COPY_ESCAPES.get(char, char)
+
+
+def parse_copy_row(line: bytes) -> t.List[t.Optional[bytes]]:
+    """Split a row output by COPY in text format into its raw fields."""
+    return [
+        None if field == b"\\N" else COPY_ESCAPE.sub(_unescape_copy, field)
+        for field in line.split(b"\t")
+    ]
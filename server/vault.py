@@ -0,0 +1,122 @@
+"""In-memory cache of users' identifiers.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import typing as t
+from collections import OrderedDict
+from time import monotonic
+
+from aiohttp import web
+
+from . import config
+
+# Rough per-identifier overhead of the cached objects, in bytes
+ROW_OVERHEAD = 200
+
+T = t.TypeVar("T")
+
+
+class VaultCache:
+    """Cache each user's whole set of identifiers, sorted.
+
+    Depending on the mode, the cached rows are either encrypted, as stored
+    in the database, or already decrypted. The least recently used vaults
+    are evicted above the memory cap, and all expire after a delay.
+    """
+    def __init__(self, max_bytes: int, ttl: float, plaintext: bool) -> None:
+        """Initialize the cache."""
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.plaintext = plaintext
+        self.size = 0
+        self._vaults: t.OrderedDict[int, t.Tuple[float, int, t.List[t.Any],
+                                                 t.Dict[t.Any, t.Any],
+                                                 t.Optional[int]]]
+        self._vaults = OrderedDict()
+        self._generations: t.Dict[int, int] = {}
+
+    def generation(self, user_id: int) -> int:
+        """Get the number of times a user's vault was invalidated.
+
+        Take it before reading the vault, to pass it to put.
+        """
+        return self._generations.get(user_id, 0)
+
+    def get(
+        self,
+        user_id: int,
+        version: t.Optional[int] = None,
+    ) -> t.Optional[t.List[t.Any]]:
+        """Get a user's cached identifiers.
+
+        When a version is given, the identifiers must have been cached with
+        it, which catches the writes handled by other processes.
+        """
+        entry = self._vaults.get(user_id)
+        if entry is None or version is not None and entry[4] != version:
+            return None
+        if entry[0] < monotonic():
+            self._discard(user_id)
+            return None
+        self._vaults.move_to_end(user_id)
+        return entry[2]
+
+    def index(
+        self,
+        user_id: int,
+        build: t.Callable[[t.List[t.Any]], T],
+        version: t.Optional[int] = None,
+    ) -> t.Optional[T]:
+        """Get a structure built from a user's cached identifiers.
+
+        It is built on first use, then kept until the vault leaves the cache.
+        The version is checked as by get.
+        """
+        rows = self.get(user_id, version)
+        if rows is None:
+            return None
+        indexes = self._vaults[user_id][3]
+        if build not in indexes:
+            indexes[build] = build(rows)
+        return indexes[build]
+
+    def put(
+        self,
+        user_id: int,
+        rows: t.List[t.Any],
+        generation: int,
+        version: t.Optional[int] = None,
+    ) -> None:
+        """Cache a user's identifiers, unless they changed since read."""
+        if not self.max_bytes or generation != self.generation(user_id):
+            return
+        size = sum(ROW_OVERHEAD + sum(map(len, row.values())) for row in rows)
+        if size > self.max_bytes:
+            return
+        self._discard(user_id)
+        self._vaults[user_id] = (monotonic() + self.ttl, size, rows, {},
+                                 version)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._discard(next(iter(self._vaults)))
+
+    def invalidate(self, user_id: int) -> None:
+        """Drop a user's cached identifiers, after they changed."""
+        self._generations[user_id] = self.generation(user_id) + 1
+        self._discard(user_id)
+
+    def _discard(self, user_id: int) -> None:
+        """Remove a vault from the cache."""
+        entry = self._vaults.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+async def startup(app: web.Application) -> None:
+    """Create the cache."""
+    app["vault.cache"] = VaultCache(
+        config.VAULT_CACHE_BYTES if config.VAULT_CACHE else 0,
+        config.VAULT_CACHE_TTL,
+        config.VAULT_CACHE_PLAINTEXT,
+    )
@@ -0,0 +1,96 @@
+"""Multi-process serving.
+
+Each worker binds the port with SO_REUSEPORT, the kernel balancing the
+connections between them. The supervisor restarts the workers which die,
+and stops them all gracefully on SIGINT or SIGTERM.
+
+Copyright (C) 2021  Faholan <https://github.com/Faholan>
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import typing as t
+from multiprocessing.connection import wait
+from time import monotonic
+
+from aiohttp import web
+
+from . import config, storage
+from .main import make_app
+
+logger = logging.getLogger(__name__)
+
+
+def serve(workers: int) -> None:
+    """Run a worker until it is told to stop."""
+    # Leave the terminal's process group, so that only the supervisor
+    # receives ^C, and each worker a single signal to stop
+    os.setpgrp()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    web.run_app(
+        make_app(workers),
+        reuse_port=True,
+        shutdown_timeout=config.SHUTDOWN_TIMEOUT,
+        print=None,
+        **config.AIOHTTP,
+    )
+
+
+def supervise(workers: int) -> None:
+    """Run workers, restarting the ones which die, until stopped."""
+    # Create the key file before the workers race to
+    storage.load_secret()
+
+    context = multiprocessing.get_context("fork")
+    processes: t.List[t.Optional[multiprocessing.process.BaseProcess]]
+    processes = [None] * workers
+    started = [float("-inf")] * workers
+    stopping = False
+
+    def stop(signum: int, frame: t.Any) -> None:
+        """Stop supervising."""
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info("Serving on %s:%s with %d workers", config.AIOHTTP["host"],
+                config.AIOHTTP["port"], workers)
+    while not stopping:
+        for slot, process in enumerate(processes):
+            if process is not None:
+                if process.is_alive():
+                    continue
+                logger.warning("Worker %d exited with code %s", process.pid,
+                               process.exitcode)
+                processes[slot] = None
+            # Don't spin on workers failing at startup
+            if monotonic() - started[slot] >= config.WORKER_RESTART_DELAY:
+                processes[slot] = context.Process(
+                    target=serve,
+                    args=(workers, ),
+                    name=f"worker-{slot}",
+                )
+                processes[slot].start()
+                started[slot] = monotonic()
+        wait(
+            [process.sentinel for process in processes if process],
+            timeout=config.WORKER_RESTART_DELAY,
+        )
+
+    logger.info("Stopping the workers")
+    running = [process for process in processes if process]
+    for process in running:
+        process.terminate()
+    # Leave a few more seconds to the cleanup of the workers
+    deadline = monotonic() + config.SHUTDOWN_TIMEOUT + 5
+    for process in running:
+        process.join(max(deadline - monotonic(), 0))
+        if process.is_alive():
+            logger.warning("Worker %d did not stop in time", process.pid)
+            process.kill()
+            process.join()